@@ -1,6 +1,5 @@
-from sys import getsizeof as dictsize
-import time
 import urllib
+import numpy as np
 import pandas as pd
 import urllib
 import urllib.request
@@ -9,6 +8,10 @@ try:
     import _pipeline.pypackages.data.config as in_config
     from _pipeline.pypackages.Azure import Azure
     from _pipeline.pypackages.urlHandler import UrlHandler
+    from _pipeline.pypackages.elevationProvider import GetProvider
+    from _pipeline.pypackages.elevationCache import ElevationCache
+    from _pipeline.pypackages.pipelineMetrics import GetMetrics
+    from _pipeline.pypackages.checkpointJournal import GetJournal
     AzurePackage = Azure(in_config)
     Url = UrlHandler(in_config)
     
@@ -19,53 +22,48 @@ except ImportError as e:
 
 def collectStopElevations():
     #===========================================================================
-    # 1. Create Request Batches
+    # 1. Collect Coordinates
     #===========================================================================
-    # A. Collect all items in the 'stops' and  'depots' schemata from the shared team Database.
-    # B. Reduce Dataframe by removing dupicate coordinates.
-    # C. Pop() coordinates based on batch sizes no greater than 9700 bytes.
-    # D. Add each coordinate to a list of batches to send the the Open-elevations API
+    # A. Collect the id and coordinates of the 'stops' and 'depots' schemata from the shared team Database.
+    # B. Remove dupicate coordinates in the database with SELECT DISTINCT.
+    # C. Drop coordinates already in the 'stopElevations' schema and take any
+    #    others held in the local elevation cache from there.
     #-----------------------------------------------------
     # Attributes
     #-----------------------------------------------------
     # Azure class imported with call functionality (in)
     # Config File (in)
-    # listOfBatches (out)
+    # allStops (out)
 
-    listOfBatches = []
-    batches = {"locations" : []}
+    allStops = pd.DataFrame(columns=["stop_id", "stop_lat", "stop_lon"])
+    cachedElevations = pd.DataFrame(columns=["latitude", "longitude", "elevation"])
+    cache = ElevationCache(in_config.elevCacheFile, in_config.elevCachePrecision)
+    metrics = GetMetrics()
     try:
-        rawShapedf = AzurePackage("SelectAllData", "stops")
-        rawDepotdf = AzurePackage("SelectAllData", "depots")
+        shapesRequest = AzurePackage("SelectData", "stops",
+                                     ["stop_id", "stop_lat", "stop_lon"],
+                                     None, None, True)
+        rawDepotdf = AzurePackage("SelectData", "depots", ["name", "lat", "lon"])
         rawDepotdf.columns = ["stop_id","stop_lat","stop_lon"]
-        shapesDF = rawShapedf[["stop_id", "stop_lat","stop_lon"]]
-        shapesRequest = shapesDF.drop_duplicates(subset=None, 
-                                                keep='first', 
-                                                inplace=False)
         allStops = pd.concat([shapesRequest,rawDepotdf], axis=0).reset_index(drop=True)
-        shapesCoordinates = Url("generateLocationRequest", allStops)
-        for key, value in shapesCoordinates.items():
-            if key == "locations":
-                locations = value
-        while len(locations) != 0:
-            for each in locations:
-                if dictsize(batches["locations"]) +\
-                                    dictsize(each) +\
-                                    dictsize(batches) < 9700:
-                    location = locations.pop(0)
-                    batches["locations"].append(location)
-                else:
-                    location = locations.pop(0)
-                    batches["locations"].append(location)
-                    listOfBatches.append(batches)
-                    batches = {"locations" : []}
-            for each in listOfBatches:
-                if dictsize(each) > 10000:
-                    raise Exception(in_config.RequestToBig)
-                else:
-                    pass
-        else:
-            print("All values added to the list of requests.")
+        try:
+            existing = AzurePackage("SelectData", "stopElevations", ["latitude", "longitude"])
+        except Exception:
+            existing = pd.DataFrame(columns=["latitude", "longitude"])
+        inTable = np.isin(cache("Keys", allStops["stop_lat"], allStops["stop_lon"]),
+                          cache("Keys", existing["latitude"], existing["longitude"]))
+        newStops = allStops[~inTable].reset_index(drop=True)
+        elevations = cache("Lookup", newStops["stop_lat"], newStops["stop_lon"])
+        inCache = ~np.isnan(elevations)
+        cachedElevations = pd.DataFrame({"latitude": newStops["stop_lat"][inCache],
+                                         "longitude": newStops["stop_lon"][inCache],
+                                         "elevation": elevations[inCache]})
+        allStops = newStops[~inCache]
+        metrics("Count", "rows_read", len(existing.index) + len(shapesRequest.index) + len(rawDepotdf.index))
+        metrics("Count", "elevation_cache_hits", int(inCache.sum()))
+        metrics("Count", "elevation_cache_misses", int((~inCache).sum()))
+        print(f"{int(inTable.sum())} coordinates already in stopElevations, "
+              f"elevation cache {cache('Stats')}, {len(allStops)} coordinates to request.")
     except pd.io.sql.DatabaseError as e:
         print(in_config.NoSQLShema)
 
@@ -78,45 +76,53 @@ def collectStopElevations():
         print(e)
 
     #=============================================================================================
-    # 4. Send Request Batches
+    # 2. Collect Elevations
     #===========================================================================
-    # A. Send all request in the list of request batches to the API and store them into a a dataframe.
-    # B. Upload the dataframe to the database, replacing any existing schema with the same table name.
+    # A. Look up the elevation of every remaining coordinate with the provider set in the
+    #    config file, either the Open-elevations API or local DEM tiles. Coordinates are
+    #    looked up in chunks, each chunk is saved to the local cache and journaled before
+    #    the next, and coordinates this run has already journaled are skipped.
+    # B. Append the new elevations to the database, creating the schema if it does not exist.
     #-----------------------------------------------------
     # Attributes
     #-----------------------------------------------------
     # Azure class imported with call functionality (in)
-    # List of request batches (in)
-    listOfObjects = []
-    listOfElevations = []
-    ListOfDicts = []
-
-    print(f"There are {len(listOfBatches)} batches to collect.")
+    # allStops (in)
+    print(f"There are {len(allStops)} elevations to collect.")
 
-    Iteration = 0
     try:
-        for each in listOfBatches:
-            attempts = 0
-            while attempts < 5:
-                try:
-                    ListOfDicts.append(Url("mineElevationData",each))
-                    break
-                except urllib.error.HTTPError:
-                    attempts = attempts+1
-            Iteration = Iteration + 1
-            print(f"Elevation {Iteration} Collected")
-            time.sleep(2)
-        for each in ListOfDicts:
-            for key, value in each.items():
-                if type(value) is list:
-                    listOfObjects.append(value)
-
-        for each in listOfObjects:
-            for elevation in each:
-                listOfElevations.append(elevation)
-                Iteration = Iteration +1
-        df = pd.DataFrame(listOfElevations)
-        dfTrimmed = df.drop_duplicates()
+        provider = GetProvider(in_config, Url)
+        journal = GetJournal(in_config.journalFile, in_config.journalRunId)
+        print(f"Journal run id: {journal.runId}")
+        stage = "elevations:stops"
+        itemIds = cache("Keys", allStops["stop_lat"], allStops["stop_lon"]).astype(str)
+        done = journal("Done", stage)
+        elevations = np.array([done.get(itemId, np.nan) for itemId in itemIds], dtype="float64")
+        pending = np.flatnonzero(np.isnan(elevations))
+        print(f"{len(itemIds) - len(pending)} elevations already collected by this run.")
+        size = in_config.elevCheckpointSize
+        for first in range(0, len(pending), size):
+            chunk = pending[first:first + size]
+            with metrics("Timer", "elevation_lookup"):
+                found = provider("Lookup", allStops["stop_lat"].iloc[chunk], allStops["stop_lon"].iloc[chunk])
+            elevations[chunk] = found
+            ok = ~np.isnan(found)
+            cache("Store", allStops["stop_lat"].iloc[chunk[ok]], allStops["stop_lon"].iloc[chunk[ok]], found[ok])
+            journal("Record", stage, zip(itemIds[chunk[ok]], found[ok].tolist()), "done")
+            journal("Record", stage, ((itemId, None) for itemId in itemIds[chunk[~ok]]), "failed")
+            print(f"Collected {first + len(chunk)} of {len(pending)}, journal {journal('Stats', stage)}")
+        if hasattr(provider, "fetcher"):
+            fetchStats = provider.fetcher("Stats")
+            metrics("Count", "elevation_http_calls", fetchStats["requests"])
+            metrics("Count", "elevation_retries", fetchStats["retries"])
+            metrics("Count", "elevation_bytes_received", fetchStats["bytes"])
+        if np.isnan(elevations).any():
+            raise Exception("Failed to collect all elevations, please try again.")
+        print(f"{len(elevations)} Elevations Collected")
+        df = pd.DataFrame({"latitude": allStops["stop_lat"].to_numpy(dtype="float64"),
+                           "longitude": allStops["stop_lon"].to_numpy(dtype="float64"),
+                           "elevation": elevations})
+        dfTrimmed = pd.concat([cachedElevations, df], axis=0).drop_duplicates()
         try:
             sumElevation = dfTrimmed["elevation"].sum()
         except: 
@@ -129,12 +135,16 @@ def collectStopElevations():
         print(in_config.UNKMGO)
         print(type(e))
         print(e)
+    finally:
+        cache.Close()
     try:
-        print("Uploading to SQL.")
-        SqlDataCursor = AzurePackage("UploadToSQL",
-                                    dfTrimmed,
-                                    "stopElevations",
-                                    in_config.teamConnQuote)
+        print(f"Appending {len(dfTrimmed)} new elevations to SQL.")
+        with metrics("Timer", "sql_write"):
+            SqlDataCursor = AzurePackage("AppendToSQL",
+                                        dfTrimmed,
+                                        "stopElevations",
+                                        in_config.teamConnQuote)
+        metrics("Count", "rows_written", len(dfTrimmed.index))
         print("Upload Complete.")
     except pd.io.sql.DatabaseError as e:
         print(in_config.NoSQLShema)
@@ -0,0 +1,105 @@
+# Build Level of Detail Shapes for the App
+# ========================================
+# Simplify the GTFS shapes & the dead trip & dead leg routes at several
+# tolerances, one per map zoom level, so that the app only needs to fetch
+# the points it can actually draw at the current zoom.
+# Each level is saved to the shape_lods table as one row per shape, with the
+# points packed into the same geometry blob used for the route tables.
+
+import numpy as np
+import pandas as pd
+import importlib.util
+
+# Map zoom levels to build. The tolerance for a zoom is the ground width of
+# pixel_tolerance screen pixels at that zoom, e.g. about 6m at zoom 14 over
+# Dublin, so dropped points are never further than that from the line drawn.
+lod_zooms = [10, 12, 14, 16]
+pixel_tolerance = 1.0
+
+# Create a function for the ground width of one map pixel in metres at a
+# zoom level & latitude, for 256 pixel web mercator tiles
+def metresPerPixel (zoom, latitude) :
+    return(156543.03392 * np.cos(np.radians(latitude)) / 2 ** zoom)
+
+def run_all_lods (connection, conn_string, zooms = lod_zooms) :
+
+    # Load common function file
+    spec = importlib.util.spec_from_file_location("functions", "C:/MyApps/dapTbElectricDublinBus/_pipeline/functions.py")
+    functs = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(functs)
+
+    routeCodec = functs.loadPackage('routeCodec')
+    shapeSimplifier = functs.loadPackage('shapeSimplifier')
+
+    #%%
+    # Extract Shapes from Azure SQL DB
+    # ================================
+    # GTFS shapes come as one row per point, the dead trip & dead leg routes
+    # as one row per route which is expanded to points here
+    query = """SELECT shape_id, shape_pt_lat AS latitude, shape_pt_lon AS longitude,
+                      shape_pt_sequence AS point_order
+               FROM shapes ORDER BY shape_id, shape_pt_sequence"""
+    gtfs_shapes = pd.read_sql_query(query, connection)
+    functs.metrics().Count('rows_read', len(gtfs_shapes.index))
+    gtfs_shapes['shape_type'] = 'gtfs'
+
+    codec = routeCodec.RouteCodec(summaryColumns = [])
+    all_shapes = [gtfs_shapes]
+    for shape_type, table in [('dead_trip', 'dead_trip_routes'), ('dead_leg', 'dead_leg_routes')] :
+        query = 'SELECT dead_trip_unique_id, n_points, geometry FROM {}'.format(table)
+        routes = pd.read_sql_query(query, connection)
+        functs.metrics().Count('rows_read', len(routes.index))
+        points = codec.Decode(routes).rename(columns = {'dead_trip_unique_id': 'shape_id'})
+        points['shape_type'] = shape_type
+        all_shapes.append(points)
+
+    # Simplify every kind of shape together, keyed by type & id
+    shapes = pd.concat(all_shapes, ignore_index = True)
+    shapes['shape_id'] = shapes['shape_id'].astype(str)
+    shapes['shape_key'] = shapes['shape_type'] + ':' + shapes['shape_id']
+    print('{} points in {} shapes'.format(len(shapes.index), shapes['shape_key'].nunique()))
+
+    #%%
+    # Simplify Each Shape at Each Zoom Level
+    # ======================================
+    mean_lat = shapes['latitude'].mean()
+    levels = []
+    for zoom in zooms :
+        tolerance = round(pixel_tolerance * metresPerPixel(zoom, mean_lat), 2)
+        simplifier = shapeSimplifier.ShapeSimplifier(
+            tolerance = tolerance,
+            spacing = 0,
+            groupColumn = 'shape_key',
+            latColumn = 'latitude',
+            lonColumn = 'longitude',
+            sequenceColumn = 'point_order'
+            )
+        with functs.metrics().Timer('simplify_shapes') :
+            simplified = simplifier.Simplify(shapes)
+        print('Zoom {} ({}m): {}'.format(zoom, tolerance, simplifier.Stats()))
+        level = simplified.loc[simplified['keep'], ['shape_key', 'shape_type', 'shape_id', 'latitude', 'longitude']].copy()
+        level['zoom'] = zoom
+        level['tolerance_m'] = tolerance
+        levels.append(level)
+
+    # Pack the points of each shape & level into one row
+    lod_codec = routeCodec.RouteCodec(idColumn = 'shape_key',
+                                      summaryColumns = ['shape_type', 'shape_id', 'zoom', 'tolerance_m'])
+    lods = pd.concat([lod_codec.Encode(level) for level in levels], ignore_index = True)
+    lods = lods.drop(columns = 'shape_key')
+
+    #%%
+    # Save Levels of Detail to Azure SQL db
+    # =====================================
+    from sqlalchemy import types
+    engine = functs.loadPackage('resourcePool').GetPool().SQLEngine(conn_string)
+    functs.saveLogInfo(
+        table = 'shape_lods',
+        df = lods,
+        eng = engine,
+        dtype = {'geometry': types.LargeBinary()}
+        )
+
+if __name__ == '__main__':
+    # when executed as script, run this function
+    run_all_lods()
@@ -10,7 +10,8 @@ CREATE INDEX idx_trip_id ON stop_times (trip_id);
 CREATE INDEX idx_stop_id ON stops (stop_id);
 
 
-CREATE INDEX idx_dead_trip_unique_id ON dead_leg_shapes (dead_trip_unique_id);
+CREATE INDEX idx_dead_trip_unique_id ON dead_trip_routes (dead_trip_unique_id) INCLUDE (distance_km, time_hrs, n_points);
+CREATE INDEX idx_dead_trip_unique_id ON dead_leg_routes (dead_trip_unique_id) INCLUDE (distance_km, time_hrs, n_points);
 
 CREATE INDEX idx_route_id ON distances (route_id);
 CREATE INDEX idx_service_id ON distances (service_id);
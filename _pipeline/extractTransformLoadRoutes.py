@@ -3,7 +3,12 @@
 import pandas as pd
 import importlib.util
 
-def run_all_etlr (keys, connection, conn_string) :
+# In stream mode the route points are converted into chunks of chunk_rows rows
+# & appended to the route tables as they are produced, which keeps memory use
+# flat. Otherwise each route table is built in full before it is saved.
+# Routes are saved one row per route in dead_trip_routes & dead_leg_routes,
+# with the dead_trip_shapes & dead_leg_shapes views expanding them to points.
+def run_all_etlr (keys, connection, conn_string, stream = True, chunk_rows = 100000) :
 
     # Load common function file
     spec = importlib.util.spec_from_file_location("functions", "C:/MyApps/dapTbElectricDublinBus/_pipeline/functions.py")
@@ -24,6 +29,7 @@ def run_all_etlr (keys, connection, conn_string) :
     # Extract the dead_leg_log table created from R script analysis of GTFS
     query = 'SELECT * FROM dead_leg_log'   
     dead_leg_log = pd.read_sql_query(query, connection)
+    functs.metrics().Count('rows_read', len(dead_trip_log.index) + len(dead_leg_log.index))
     
     #%%    
     # Extract Raw Route Data from Azure Cosmos DB for MongoDB API
@@ -31,10 +37,10 @@ def run_all_etlr (keys, connection, conn_string) :
     # Azure Cosmos DB service implements wire protocols for common NoSQL APIs 
     # including Cassandra, MongoDB. This allows you to use your familiar NoSQL 
     # client drivers and tools to interact with your Cosmos database.
-    from pymongo import MongoClient
-    
     uri = "mongodb://electric-bus-cosmos-east-us:" + keys.cosmos_key + "@electric-bus-cosmos-east-us.mongo.cosmos.azure.com:10255/?ssl=true&retrywrites=false&replicaSet=globaldb&maxIdleTimeMS=120000&appName=@electric-bus-cosmos-east-us@"
-    client = MongoClient(uri)
+    # Borrow the shared client so the connection is reused across steps
+    pool = functs.loadPackage('resourcePool').GetPool()
+    client = pool.MongoClient(uri)
     
     # Create database
     #import pprint
@@ -45,45 +51,58 @@ def run_all_etlr (keys, connection, conn_string) :
     # Collection for route data
     routes = db.routes
     
-    #%%
-    # Get Dead TRIP route data from Cosmos, tabulate it, and save to Azure SQL db
-    dead_trip_shapes_df = functs.tabulateRouteInfo(
-        object_vec = dead_trip_log['object_id'], 
-        trip_vec = dead_trip_log['dead_unique_id'],             
-        collection = routes    
-        )
-    
-    
-    #%%
-    # Get Dead LEG route data from Cosmos, tabulate it, and save to Azure SQL db
-    dead_leg_shapes_df = functs.tabulateRouteInfo(
-        object_vec = dead_leg_log['object_id'], 
-        trip_vec = dead_leg_log['dead_unique_id'],             
-        collection = routes    
-        )
-    
-    
     #%%
     # Create code to write a pandas dataframe to SQL table
     # Using a similar method to dbWriteTable in R
-    from sqlalchemy import create_engine
-    from urllib.parse import quote_plus
+    engine = pool.SQLEngine(conn_string)
     
-    quoted = quote_plus(conn_string)
-    new_con = 'mssql+pyodbc:///?odbc_connect={}'.format(quoted)
-    engine = create_engine(new_con,  fast_executemany = True)
+    # The Dead TRIP & Dead LEG phases read different documents & write to
+    # different tables, so they run side by side, each with its own pooled
+    # SQL connection & the shared Cosmos client
+    if stream :
+        #%%
+        # Stream Dead TRIP & Dead LEG route data from Cosmos into the Azure SQL db
+        def streamShapes (table, view, log) :
+            return(lambda: functs.saveRouteShapes(
+                table = table, 
+                view = view,
+                chunks = functs.iterRouteInfo(
+                    object_vec = log['object_id'], 
+                    trip_vec = log['dead_unique_id'],             
+                    collection = routes,
+                    chunk_rows = chunk_rows
+                    ),
+                eng = engine
+                ))
+        
+        functs.runConcurrently({
+            'dead_trip_routes': streamShapes('dead_trip_routes', 'dead_trip_shapes', dead_trip_log),
+            'dead_leg_routes': streamShapes('dead_leg_routes', 'dead_leg_shapes', dead_leg_log)
+            })
+        return(None)
     
-    functs.saveLogInfo(
-        table = 'dead_trip_shapes', 
-        df = dead_trip_shapes_df,
-        eng = engine
-        )
+    #%%
+    # Get Dead TRIP & Dead LEG route data from Cosmos, tabulate it, and save 
+    # to Azure SQL db
+    def tabulateShapes (table, view, log) :
+        def phase () :
+            shapes_df = functs.tabulateRouteInfo(
+                object_vec = log['object_id'], 
+                trip_vec = log['dead_unique_id'],             
+                collection = routes    
+                )
+            functs.saveRouteShapes(
+                table = table, 
+                view = view,
+                chunks = [shapes_df],
+                eng = engine
+                )
+        return(phase)
     
-    functs.saveLogInfo(
-        table = 'dead_leg_shapes', 
-        df = dead_leg_shapes_df,
-        eng = engine
-        )
+    functs.runConcurrently({
+        'dead_trip_routes': tabulateShapes('dead_trip_routes', 'dead_trip_shapes', dead_trip_log),
+        'dead_leg_routes': tabulateShapes('dead_leg_routes', 'dead_leg_shapes', dead_leg_log)
+        })
 
 if __name__ == '__main__':
     # when executed as script, run this function
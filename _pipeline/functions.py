@@ -1,8 +1,55 @@
 import pandas as pd
+import numpy as np
 import json
 from bson import ObjectId
 import requests
 import time
+import sqlite3
+import threading
+import queue
+import gzip
+import os
+import sys
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+
+
+# Create a function to load a module from the pypackages folder. Modules are
+# registered under the same name as a normal package import so that they are
+# only loaded once per process.
+def loadPackage (name) :
+    module_name = '_pipeline.pypackages.' + name
+    if module_name in sys.modules :
+        return(sys.modules[module_name])
+    filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pypackages', name + '.py')
+    spec = importlib.util.spec_from_file_location(module_name, filepath)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return(module)
+
+
+# Create a function to return the metrics shared by every step of the run,
+# timers & counters for rows, requests, retries, cache hits, etc.
+def metrics () :
+    return(loadPackage('pipelineMetrics').GetMetrics())
+
+
+# Create a function to run independent pipeline phases at the same time on a
+# shared worker pool. phases is a dict of name -> function taking no arguments,
+# the results are returned in a dict under the same names once all phases are
+# done. An error in any phase is raised after the other phases finish.
+def runConcurrently (phases, max_workers = None) :
+    s = time.time()
+    def timed (name, phase) :
+        with metrics().Timer(name) :
+            return(phase())
+    with ThreadPoolExecutor(max_workers = max_workers or len(phases)) as pool :
+        futures = {name: pool.submit(timed, name, phase) for name, phase in phases.items()}
+    results = {name: future.result() for name, future in futures.items()}
+    print('Phases {} took {}s'.format(', '.join(phases), round(time.time() - s, 1)))
+    return(results)
 
 
 # Create a class for access keys, i.e., db passwords, subscription keys, etc.
@@ -79,99 +126,456 @@ def load_connection_names (filepath) :
         json_file.close()
         
         
-# Create function to save tabulated data to Azure SQL db
-def saveLogInfo (table, df, eng, chunks = 10000):
+# Create function to save tabulated data to Azure SQL db. The data is written
+# to a staging table which then replaces the table in one transaction. Column
+# types can be set explicitly with dtype, a dict of SQLAlchemy types.
+def saveLogInfo (table, df, eng, chunks = 10000, dtype = None):
     s = time.time()
-    df.to_sql(table, eng, if_exists = 'replace', chunksize = chunks, index = False)
+    bulk_loader = loadPackage('bulkLoader').BulkLoader(eng, chunks)
+    with metrics().Timer('sql_write') :
+        stats = bulk_loader.Load(table, df, dtype)
+    metrics().Count('rows_written', stats['rows'] if stats else 0)
     print('Time taken: ' + str(round(time.time() - s, 1)) + 's')
     return(None)
 
 
-# Create a function for tabulating json route data
-def tabulateRouteInfo (object_vec, trip_vec, collection):
-    # Create a tuple of lists to hold parsed JSON data so that it can be 
-    # easily passed into a dataframe for easy loading to RDMS table.
-    dead_trip_unique_id, latitude, longitude, point_order, distance_km, time_hrs, mode = ([], [], [], [], [], [], []) 
-    for count, object_id in enumerate(object_vec):
-        print('Processing dead trip {} of {}'.format(count + 1, len(object_vec)))
-        post_id = ObjectId(object_id)        
-        route_data = collection.find_one({"_id": post_id})
+# Create a function for tabulating routes into fixed size dataframe chunks.
+# routes is an iterable of (positions, route) pairs, where route is the first
+# route of an Azure Maps batch item & positions lists the position in trip_vec
+# of every trip using it. The points are parsed straight into NumPy column
+# buffers of chunk_rows rows & a chunk is yielded each time the buffers fill,
+# so memory use depends on the chunk size rather than the network size.
+def tabulateRoutes (routes, trip_vec, chunk_rows = 100000, keep_position = False):
+    trip_ids = pd.Series(trip_vec).to_numpy()
+    buffers = {'position': np.empty(chunk_rows, dtype = 'int64'),
+               'latitude': np.empty(chunk_rows, dtype = 'float64'),
+               'longitude': np.empty(chunk_rows, dtype = 'float64'),
+               'point_order': np.empty(chunk_rows, dtype = 'int32'),
+               'distance_km': np.empty(chunk_rows, dtype = 'float64'),
+               'time_hrs': np.empty(chunk_rows, dtype = 'float64')}
     
+    # Create a dataframe from the first n_rows rows of the buffers
+    def makeChunk (n_rows) :
+        chunk = pd.DataFrame({'dead_trip_unique_id': trip_ids[buffers['position'][:n_rows]]})
+        for name in ['latitude', 'longitude', 'point_order', 'distance_km', 'time_hrs'] :
+            chunk[name] = buffers[name][:n_rows].copy()
+        if keep_position :
+            chunk['position'] = buffers['position'][:n_rows].copy()
+        return(chunk)
+    
+    n_rows = 0
+    for positions, route in routes :
         # Grab blocks of info from the route data
-        route_points = route_data['batchItems'][0]['response']['routes'][0]['legs'][0]['points']
-        summary_info = route_data['batchItems'][0]['response']['routes'][0]['summary']
-        sections_info = route_data['batchItems'][0]['response']['routes'][0]['sections'][0]
+        route_points = route['legs'][0]['points']
+        summary_info = route['summary']
+        n_points = len(route_points)
+        latitude = np.fromiter((point['latitude'] for point in route_points), dtype = 'float64', count = n_points)
+        longitude = np.fromiter((point['longitude'] for point in route_points), dtype = 'float64', count = n_points)
+        # Point order is important to ensure correct point
+        # order after loading data from SQL db
+        point_order = np.arange(1, n_points + 1, dtype = 'int32')
+        
+        # Copy the points into the buffers once for each trip using them,
+        # a route can be split across chunks if the buffers fill up
+        for position in positions :
+            done = 0
+            while done < n_points :
+                take = min(n_points - done, chunk_rows - n_rows)
+                rows = slice(n_rows, n_rows + take)
+                buffers['position'][rows] = position
+                buffers['latitude'][rows] = latitude[done:done + take]
+                buffers['longitude'][rows] = longitude[done:done + take]
+                buffers['point_order'][rows] = point_order[done:done + take]
+                buffers['distance_km'][rows] = summary_info['lengthInMeters'] / 1000
+                buffers['time_hrs'][rows] = round(summary_info['travelTimeInSeconds'] / (60*60), 6)
+                n_rows += take
+                done += take
+                if n_rows == chunk_rows :
+                    yield(makeChunk(n_rows))
+                    n_rows = 0
+    
+    if n_rows != 0 :
+        yield(makeChunk(n_rows))
+
+
+# Create a function for streaming json route data from Cosmos DB as fixed size
+# dataframe chunks. Route documents are read in batches with an $in query &
+# projected down to just the route points & summary before being tabulated.
+def iterRouteInfo (object_vec, trip_vec, collection, batch_size = 500, chunk_rows = 100000, keep_position = False):
+    # Several trips can share a single route document, so map each document
+    # to the position of every trip that uses it
+    positions = {}
+    for count, object_id in enumerate(object_vec) :
+        positions.setdefault(ObjectId(object_id), []).append(count)
+    unique_ids = list(positions.keys())
+    projection = {'batchItems.response.routes.legs.points': 1, 
+                  'batchItems.response.routes.summary': 1}
     
-        # Now loop through and append data to the appropriate lists
-        print('Parsing points...')
-        for point_count, point in enumerate(route_points) :
-            dead_trip_unique_id.append(trip_vec[count])
-            latitude.append(point['latitude'])
-            longitude.append(point['longitude'])
-            # Point order is important to ensure correct point
-            # order after loading data from SQL db
-            point_order.append(point_count + 1)
-            distance_km.append(summary_info['lengthInMeters'] / 1000)
-            time_hrs.append(round(summary_info['travelTimeInSeconds'] / (60*60), 6))
-            mode.append(sections_info['travelMode'])
-
-    # Create a dataframe & populate with the list data    
-    route_df = pd.DataFrame(dead_trip_unique_id, columns = ['dead_trip_unique_id'])
-    route_df['latitude'] = latitude
-    route_df['longitude'] = longitude
-    route_df['point_order'] = point_order
-    route_df['distance_km'] = distance_km
-    route_df['time_hrs'] = time_hrs
+    def findRoutes () :
+        n_found = 0
+        for i in range(0, len(unique_ids), batch_size) :
+            batch = unique_ids[i:i + batch_size]
+            print('Processing dead trips {} to {} of {}'.format(i + 1, i + len(batch), len(unique_ids)))
+            for route_data in collection.find({'_id': {'$in': batch}}, projection) :
+                n_found += 1
+                metrics().Count('cosmos_documents_read')
+                yield(positions[route_data['_id']], route_data['batchItems'][0]['response']['routes'][0])
+        if n_found != len(unique_ids) :
+            print('Warning: {} route documents not found'.format(len(unique_ids) - n_found))
     
-    return(route_df)
+    return(tabulateRoutes(findRoutes(), trip_vec, chunk_rows, keep_position))
 
 
-# Create a function for creating stop objects from stop ids
-def getStopCoords(start_stop, end_stop, connection) :
-    query = "SELECT stop_lat, stop_lon FROM stops WHERE stop_id = '{}'".format(start_stop)   
-    start_stop_coords = pd.read_sql_query(query, connection) 
-    start_stop_coords = start_stop_coords.values.tolist()[0]
-    query = "SELECT stop_lat, stop_lon FROM stops WHERE stop_id = '{}'".format(end_stop)   
-    end_stop_coords = pd.read_sql_query(query, connection)
-    end_stop_coords = end_stop_coords.values.tolist()[0]
-    return(stop(start_stop_coords[0], start_stop_coords[1], end_stop_coords[0], end_stop_coords[1]))  
-
-# Create a function for creating stop objects from stop ids
-def getLegCoords(start_stop, end_stop, connection) :    
-    query = "SELECT name, lat, lon FROM depots"   
-    depots = pd.read_sql_query(query, connection) 
+# Create a function for tabulating json route data into a single dataframe
+def tabulateRouteInfo (object_vec, trip_vec, collection, batch_size = 500, chunk_rows = 100000):
+    chunks = list(iterRouteInfo(object_vec, trip_vec, collection, batch_size, chunk_rows, keep_position = True))
+    if len(chunks) == 0 :
+        return(pd.DataFrame(columns = ['dead_trip_unique_id', 'latitude', 'longitude', 'point_order', 'distance_km', 'time_hrs']))
     
-    if start_stop[0:3].isdigit() :
-        query = "SELECT stop_lat, stop_lon FROM stops WHERE stop_id = '{}'".format(start_stop)   
-        start_stop_coords = pd.read_sql_query(query, connection) 
-        start_stop_coords = start_stop_coords.values.tolist()[0]
+    # Documents come back in any order, so put the rows back in trip order
+    route_df = pd.concat(chunks, ignore_index = True)
+    route_df = route_df.sort_values('position', kind = 'stable').drop(columns = 'position').reset_index(drop = True)
     
+    return(route_df)
+
+
+# Create function to save a stream of dataframe chunks to Azure SQL db. Each
+# chunk is appended to a staging table as it arrives & the staging table 
+# replaces the table once the stream is finished.
+def saveChunks (table, chunks, eng, chunks_per_insert = 10000, dtype = None):
+    s = time.time()
+    bulk_loader = loadPackage('bulkLoader').BulkLoader(eng, chunks_per_insert)
+    with metrics().Timer('sql_write') :
+        stats = bulk_loader.Load(table, chunks, dtype)
+    metrics().Count('rows_written', stats['rows'] if stats else 0)
+    print('Time taken: ' + str(round(time.time() - s, 1)) + 's')
+    return(None)
+
+
+# Create function to save a stream of route point chunks to Azure SQL db in
+# the compact form, one row per route with the points packed into a geometry
+# blob. On SQL Server a view with the old shapes table name & columns is
+# created over the route table, so existing queries keep working. The table
+# of point rows written by older runs is only dropped where the view can
+# replace it, other backends keep it as it is.
+def saveRouteShapes (table, view, chunks, eng, chunks_per_insert = 10000) :
+    from sqlalchemy import types
+    codec = loadPackage('routeCodec').RouteCodec()
+    saveChunks(table, codec.EncodeChunks(chunks), eng, chunks_per_insert, 
+               dtype = {'geometry': types.LargeBinary()})
+    if eng.dialect.name == 'mssql' :
+        # Dropped in the same transaction as the view is created, so a failed
+        # view leaves the old table in place
+        with eng.begin() as conn :
+            conn.exec_driver_sql("IF OBJECT_ID(N'dbo.{0}', N'U') IS NOT NULL DROP TABLE [{0}]".format(view))
+            conn.exec_driver_sql(codec.ViewSQL(view, table))
     else :
-        check_depot_name = depots['name'] == start_stop
-        if sum(check_depot_name) != 0 :
-            start_stop_coords = []
-            start_stop_coords.append(depots['lat'][check_depot_name].values.tolist()[0])
-            start_stop_coords.append(depots['lon'][check_depot_name].values.tolist()[0])
-        else :
-            print("Depot name '{}' not found".format(start_stop))
-            return(None)      
-                   
-    if end_stop[0:3].isdigit() :
-        query = "SELECT stop_lat, stop_lon FROM stops WHERE stop_id = '{}'".format(end_stop)   
-        end_stop_coords = pd.read_sql_query(query, connection)
-        end_stop_coords = end_stop_coords.values.tolist()[0]
+        print("Views are only created on SQL Server, '{}' not created & any old table of that name kept".format(view))
+    return(None)
+
+
+# Create a class for resolving stop ids & depot names to coordinates in bulk.
+# The stops & depots tables are read once and held as arrays, so a whole
+# vector of start/end ids can be resolved in one call rather than running a
+# query per dead trip. Any id missing from the index is looked up with a
+# parameterized query & added to the index.
+class coordResolver:
+  # SQL Server allows 2100 parameters per statement, leave some headroom
+  max_params = 2000
+
+  def __init__(self, connection):
+    self.connection = connection
+    # Phases running in parallel share one resolver, the lock stops them
+    # updating the index or using the connection at the same time
+    self.lock = threading.Lock()
+    stops = pd.read_sql_query("SELECT stop_id, stop_lat, stop_lon FROM stops", connection)
+    depots = pd.read_sql_query("SELECT name, lat, lon FROM depots", connection)
+    self.stop_index = pd.Index(stops['stop_id'].astype(str))
+    self.stop_coords = stops[['stop_lat', 'stop_lon']].to_numpy(dtype = 'float64')
+    self.depot_index = pd.Index(depots['name'].astype(str))
+    self.depot_coords = depots[['lat', 'lon']].to_numpy(dtype = 'float64')
+
+  # Look up stop ids that are not in the index & append them to it
+  def fetchMissingStops(self, stop_ids):
+    found = []
+    for i in range(0, len(stop_ids), self.max_params):
+      chunk = list(stop_ids[i:i + self.max_params])
+      query = "SELECT stop_id, stop_lat, stop_lon FROM stops WHERE stop_id IN ({})".format(', '.join(['?'] * len(chunk)))
+      found.append(pd.read_sql_query(query, self.connection, params = chunk))
+    if len(found) == 0 :
+      return(None)
+    found = pd.concat(found).drop_duplicates(subset = 'stop_id')
+    if len(found.index) != 0 :
+      self.stop_index = self.stop_index.append(pd.Index(found['stop_id'].astype(str)))
+      self.stop_coords = np.vstack([self.stop_coords, found[['stop_lat', 'stop_lon']].to_numpy(dtype = 'float64')])
+
+  # Resolve a vector of ids to an (n, 2) array of lat/lon, NaN where not found
+  def lookup(self, id_vec, mode = 'stops'):
+    ids = pd.Series(id_vec, dtype = 'object').astype(str).reset_index(drop = True)
+    coords = np.full((len(ids), 2), np.nan)
+    # Stop ids start with digits, anything else is treated as a depot name
+    is_stop = ids.str[0:3].str.isdigit().to_numpy()
+    if mode == 'legs' :
+      pos = self.depot_index.get_indexer(ids[~is_stop])
+      hit = pos >= 0
+      rows = np.flatnonzero(~is_stop)
+      coords[rows[hit]] = self.depot_coords[pos[hit]]
+    pos = self.stop_index.get_indexer(ids[is_stop])
+    if (pos < 0).any() :
+      self.fetchMissingStops(ids[is_stop][pos < 0].unique())
+      pos = self.stop_index.get_indexer(ids[is_stop])
+    hit = pos >= 0
+    rows = np.flatnonzero(is_stop)
+    coords[rows[hit]] = self.stop_coords[pos[hit]]
+    return(coords)
+
+  # Resolve whole start & end vectors, returning a stop object of arrays
+  def resolve(self, start_vec, end_vec, mode = 'stops'):
+    with self.lock :
+      start = self.lookup(start_vec, mode)
+      end = self.lookup(end_vec, mode)
+    return(stop(start[:, 0], start[:, 1], end[:, 0], end[:, 1]))
+
+
+# Create a function for keying a route by its rounded start & end coordinates
+def makeRouteKey (start_lat, start_lon, end_lat, end_lon, precision = 5, api_version = '', traffic = '') :
+    coords = [round(float(c), precision) for c in (start_lat, start_lon, end_lat, end_lon)]
+    return('{0:.{p}f},{1:.{p}f}:{2:.{p}f},{3:.{p}f}|{4}|{5}'.format(*coords, api_version, traffic, p = precision))
+
+
+# Create a class for a persistent local cache of Azure Maps route responses.
+# Routes are keyed by the start & end coordinates rounded to a fixed number of
+# decimal places (5 is roughly 1m) plus the API version & traffic flag, so any
+# dead trip/leg with the same end points is only requested once, ever.
+class routeCache:
+  def __init__(self, filepath, api_version, traffic, precision = 5):
+    self.api_version = api_version
+    self.traffic = traffic
+    self.precision = precision
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(filepath, check_same_thread = False)
+    self.db.execute("""CREATE TABLE IF NOT EXISTS routes (
+                         route_key TEXT PRIMARY KEY,
+                         response TEXT NOT NULL)""")
+    self.db.commit()
+
+  # Create the cache key for a start & end coordinate pair
+  def makeKey(self, start_lat, start_lon, end_lat, end_lon):
+    return(makeRouteKey(start_lat, start_lon, end_lat, end_lon, self.precision, self.api_version, self.traffic))
+
+  # Return the cached batch item for a key, or None if not cached
+  def get(self, key):
+    with self.lock :
+      row = self.db.execute("SELECT response FROM routes WHERE route_key = ?", (key,)).fetchone()
+      if row is None :
+        self.misses += 1
+        metrics().Count('route_cache_misses')
+        return(None)
+      self.hits += 1
+      metrics().Count('route_cache_hits')
+      return(json.loads(row[0]))
+
+  # Save a batch item to the cache
+  def put(self, key, item):
+    with self.lock :
+      self.db.execute("INSERT OR REPLACE INTO routes (route_key, response) VALUES (?, ?)", (key, json.dumps(item)))
+      self.db.commit()
+
+  def stats(self):
+    return({'hits': self.hits, 'misses': self.misses})
+
+  def close(self):
+    self.db.close()
+
+
+# Azure Maps batch route limits, sync requests take up to 100 queries & async
+# requests up to 700. Sets larger than the async threshold use async requests.
+maps_sync_batch_limit = 100
+maps_async_batch_limit = 700
+maps_async_threshold = 1000
+# Most batch requests in flight at once across every phase of a step
+maps_max_concurrent = 4
+# Seconds to wait on an Azure Maps response before giving up on it, & how
+# often a throttled (429), failed (5xx) or timed out request is retried with
+# the backoff of the fetchEngine package
+maps_timeout_secs = 120
+maps_retries = 5
+maps_backoff_secs = 2
+maps_max_backoff_secs = 60
+
+
+# Create a function for sending one request to Azure Maps with a timeout,
+# retrying throttled, failed & timed out requests with full jitter backoff
+# or the wait the service asks for in Retry-After. Returns the last response.
+def sendMapsRequest (method, url, headers = None, data = None) :
+    fetch = loadPackage('fetchEngine')
+    for attempt in range(maps_retries + 1) :
+        try :
+            response = requests.request(method, url, headers = headers, data = data, timeout = maps_timeout_secs)
+            metrics().Count('maps_http_calls')
+            if response.status_code not in fetch.FetchEngine.retryCodes or attempt == maps_retries :
+                return(response)
+            reason = 'status code {}'.format(response.status_code)
+            retry_after = response.headers.get('Retry-After')
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e :
+            if attempt == maps_retries :
+                raise
+            reason = type(e).__name__
+            retry_after = None
+        metrics().Count('maps_retries')
+        delay = fetch.RetryDelay(attempt, retry_after, maps_backoff_secs, maps_max_backoff_secs)
+        print('Azure Maps request failed with {}, retrying in {}s'.format(reason, round(delay, 1)))
+        time.sleep(delay)
+
+
+# Create a function for posting a batch of route queries to Azure Maps.
+# Returns the batch items in the same order as the queries.
+def postRouteBatch (query_vec, api_url, use_async = False, poll_secs = 5, max_polls = 120, budget = None) :
+    if budget is not None :
+        # Wait for a slot in the request budget shared between phases
+        with budget :
+            return(postRouteBatch(query_vec, api_url, use_async, poll_secs, max_polls))
+    payload = {'batchItems': [{'query': query_item} for query_item in query_vec]}
+    headers = {'Content-Type': 'application/json'}
     
+    if use_async :
+        # The async endpoint is the same as the sync one without '/sync'
+        url = api_url.replace('/batch/sync/', '/batch/')
     else :
-        check_depot_name = depots['name'] == end_stop
-        if sum(check_depot_name) != 0 :
-            end_stop_coords = []
-            end_stop_coords.append(depots['lat'][check_depot_name].values.tolist()[0])
-            end_stop_coords.append(depots['lon'][check_depot_name].values.tolist()[0])
+        url = api_url
+    with metrics().Timer('maps_request') :
+        response = sendMapsRequest("POST", url, headers=headers, data=json.dumps(payload))
+    
+    # Async requests return 202 & a location to poll for the results
+    if use_async and response.status_code == 202 :
+        location = response.headers['Location']
+        if 'subscription-key' not in location :
+            key = parse_qs(urlparse(api_url).query)['subscription-key'][0]
+            location = location + '&subscription-key=' + key
+        for poll in range(max_polls) :
+            time.sleep(poll_secs)
+            response = sendMapsRequest("GET", location)
+            if response.status_code != 202 :
+                break
+    
+    if response.status_code != 200 :
+        raise Exception('Error in the HTTP request, status code {}'.format(response.status_code))
+    metrics().Count('maps_bytes_received', len(response.content))
+    items = json.loads(response.text)['batchItems']
+    if len(items) != len(query_vec) :
+        raise Exception('Expected {} batch items, got {}'.format(len(query_vec), len(items)))
+    return(items)
+
+
+# Create a function for requesting many routes from Azure Maps. Queries are
+# packed into as few batch requests as the API allows & the batch items are
+# returned in query order, with None for any item whose batch failed. Batches
+# are sent concurrently, a budget semaphore shared between callers caps the
+# number of requests in flight across all of them. on_batch, if given, is
+# called with the start position & items of each batch as soon as it arrives
+# so that results can be saved before the rest are in.
+def requestRoutes (query_vec, api_url, budget = None, on_batch = None) :
+    use_async = len(query_vec) > maps_async_threshold
+    batch_size = maps_async_batch_limit if use_async else maps_sync_batch_limit
+    
+    def requestBatch (i) :
+        batch = query_vec[i:i + batch_size]
+        print('Requesting routes {} to {} of {}'.format(i + 1, i + len(batch), len(query_vec)))
+        try :
+            batch_items = postRouteBatch(batch, api_url, use_async, budget = budget)
+            print("Successful HTTP request")
+        except Exception as e:
+            print('Error1' + str(e))
+            metrics().Count('maps_failed_batches')
+            batch_items = [None] * len(batch)
+        if on_batch is not None :
+            on_batch(i, batch_items)
+        return(batch_items)
+    
+    items = []
+    with ThreadPoolExecutor(max_workers = maps_max_concurrent) as pool :
+        for batch_items in pool.map(requestBatch, range(0, len(query_vec), batch_size)) :
+            items.extend(batch_items)
+    return(items)
+
+
+# Function for getting the Azure Maps batch item of every dead trip/leg. Trips
+# & legs sharing the same start & end coordinates share one request. Returns
+# the coordinates of every trip, the route key of every trip & a dict of
+# route key -> batch item (None where the request failed), or None if the
+# start & end ids cannot all be resolved.
+# A coordResolver can be passed in so that the stops & depots tables are only
+# read once across calls, and a routeCache so that routes already requested in
+# previous runs are not requested again. Pass a budget semaphore when several
+# calls run at once so their Azure Maps requests share one limit. Pairs whose
+# route key is in skip_keys are not requested & have no item in the dict.
+def resolveRouteItems (trip_vec, start_vec, end_vec, api_url, connection, mode = 'stops', resolver = None, cache = None, budget = None, skip_keys = ()):
+    # Getting coordinates, depends on the mode (stops or legs)
+    if mode == 'stops' :
+        bad_ids = [s for s in start_vec if not str(s)[0:3].isdigit()]
+        if len(bad_ids) != 0 :
+            print("Stop id '{}' is not in the correct format - Check the mode!".format(bad_ids[0]))
+            return(None)
+    elif mode != 'legs' :
+        print("Enter a valid mode, either '{}' or '{}'".format('stops', 'legs'))
+        return(None)
+    
+    # Resolve all start & end coordinates in one go
+    if resolver is None :
+        resolver = coordResolver(connection)
+    all_coords = resolver.resolve(start_vec, end_vec, mode)
+    missing = np.isnan(all_coords.start_stop_lat) | np.isnan(all_coords.end_stop_lat)
+    if missing.any() :
+        first = np.flatnonzero(missing)[0]
+        bad_id = start_vec[first] if np.isnan(all_coords.start_stop_lat[first]) else end_vec[first]
+        print("Stop id or depot name '{}' not found".format(bad_id))
+        return(None)
+    
+    # Group trips by their start & end coordinates so that each distinct
+    # pair is only requested once
+    trip_keys = []
+    pair_index = {}
+    for trip in trip_vec :
+        if cache is not None :
+            key = cache.makeKey(all_coords.start_stop_lat[trip - 1], all_coords.start_stop_lon[trip - 1],
+                                all_coords.end_stop_lat[trip - 1], all_coords.end_stop_lon[trip - 1])
         else :
-            print("Depot name '{}' not found".format(end_stop))
-            return(None)       
+            key = makeRouteKey(all_coords.start_stop_lat[trip - 1], all_coords.start_stop_lon[trip - 1],
+                               all_coords.end_stop_lat[trip - 1], all_coords.end_stop_lon[trip - 1])
+        trip_keys.append(key)
+        if key not in pair_index :
+            pair_index[key] = trip
+    print('{} trips share {} distinct start & end pairs'.format(len(trip_keys), len(pair_index)))
+    
+    # Serve what we can from the cache & request the rest from Azure Maps
+    # in as few batches as possible
+    pair_items = {}
+    if cache is not None :
+        for key in pair_index :
+            if key not in skip_keys :
+                pair_items[key] = cache.get(key)
+        print('Route cache: {} hits, {} misses'.format(cache.hits, cache.misses))
+    missing_keys = [key for key in pair_index if key not in skip_keys and pair_items.get(key) is None]
+    query_vec = []
+    for key in missing_keys :
+        trip = pair_index[key]
+        query_vec.append('?query={0},{1}:{2},{3}'.format(all_coords.start_stop_lat[trip - 1], all_coords.start_stop_lon[trip - 1], 
+                                                        all_coords.end_stop_lat[trip - 1], all_coords.end_stop_lon[trip - 1]))
     
-    return(stop(start_stop_coords[0], start_stop_coords[1], end_stop_coords[0], end_stop_coords[1])) 
+    # Cache each batch as it arrives, so an interrupted run keeps every route
+    # received before it stopped
+    def cacheBatch (start, batch_items) :
+        for key, item in zip(missing_keys[start:start + len(batch_items)], batch_items) :
+            if cache is not None and item is not None and item.get('statusCode') == 200 :
+                cache.put(key, item)
+    
+    items = requestRoutes(query_vec, api_url, budget, on_batch = cacheBatch) if len(query_vec) != 0 else []
+    for key, item in zip(missing_keys, items) :
+        pair_items[key] = item
+    
+    return(all_coords, trip_keys, pair_items)
 
 
 # Function for looping through each unique dead trip/leg & getting route info 
@@ -179,52 +583,66 @@ def getLegCoords(start_stop, end_stop, connection) :
 # Azure SQL db.
 # Define the dead location (loc) type, i.e., either 'trip' or 'leg'. legs will  
 # be for depot to & from first/last block stop
-def getRouteInfo (trip_vec, start_vec, end_vec, api_url, dead_loc, collection, connection, mode = 'stops'):
+# The resolver, cache & budget are passed to resolveRouteItems. Trips/legs
+# sharing the same start & end coordinates share one Cosmos document.
+# Route documents are buffered & written to Cosmos with insert_many in groups
+# of flush_size.
+# With a checkpointJournal the document id of each start & end pair is
+# journaled as soon as it is written. A restart with the same run id reuses
+# the journaled documents & only requests the pairs that failed or were never
+# reached. If any route could not be saved an exception is raised once every
+# other route is saved & journaled, so the step is not recorded as finished
+# with a partial log & a resumed run retries only the failures.
+def getRouteInfo (trip_vec, start_vec, end_vec, api_url, dead_loc, collection, connection, mode = 'stops', resolver = None, cache = None, flush_size = 500, budget = None, journal = None):
     # Ceate tuple of lists for collection of log data  
     dead_unique_id, dead_type, object_id, start_lat, start_lon, end_lat, end_lon = ([], [], [], [], [], [], [])
-    for trip in trip_vec :
-        print('Executing trip {} of {}'.format(trip, len(trip_vec)))
-        start_stop = start_vec[trip - 1]
-        end_stop = end_vec[trip - 1]   
-        
-        # Getting coordinates, depends on the mode (stops or legs)
-        if mode == 'stops' :
-            if not start_stop[0:3].isdigit() :
-                print("Stop id '{}' is not in the correct format - Check the mode!".format(start_stop))
-                return(None)
-            else :
-                coords = getStopCoords(start_stop, end_stop, connection)
-        elif mode == 'legs' :
-            coords = getLegCoords(start_stop, end_stop, connection)
-        else :
-            print("Enter a valid mode, either '{}' or '{}'".format('stops', 'legs'))
+    
+    stage = 'routes:' + dead_loc
+    done = journal.Done(stage) if journal is not None else {}
+    if len(done) != 0 :
+        print('{} {} routes already saved by this run, skipping them'.format(len(done), dead_loc))
+    
+    resolved = resolveRouteItems(trip_vec, start_vec, end_vec, api_url, connection, mode, resolver, cache, budget, skip_keys = done)
+    if resolved is None :
+        return(None)
+    all_coords, trip_keys, pair_items = resolved
+    
+    # Journal the documents of each flush, keyed by start & end pair
+    position_keys = {}
+    def journalFlush (written) :
+        if journal is None :
             return(None)
+        journal.Record(stage, [(position_keys[p], str(i)) for p, i in written if i is not None], 'done')
+        journal.Record(stage, [(position_keys[p], None) for p, i in written if i is None], 'failed')
+    
+    writer = loadPackage('mongoWriter').BulkMongoWriter(collection, flush_size, onFlush = journalFlush)
+    pair_ids = {key: ObjectId(route_id) for key, route_id in done.items()}
+    failed_keys = set()
+    for count, trip in enumerate(trip_vec) :
+        print('Executing trip {} of {}'.format(trip, len(trip_vec)))
+        coords = stop(all_coords.start_stop_lat[trip - 1], all_coords.start_stop_lon[trip - 1],
+                      all_coords.end_stop_lat[trip - 1], all_coords.end_stop_lon[trip - 1])
         
-        # Create query string for start and end coordinates   
-        query_item = '?query={0},{1}:{2},{3}'.format(coords.start_stop_lat, coords.start_stop_lon, 
-                                                     coords.end_stop_lat, coords.end_stop_lon)
-        payload = {'batchItems': [{'query': query_item}]}
-        headers = {'Content-Type': 'application/json'}
+        # Skip any route that Azure Maps could not return
+        key = trip_keys[count]
+        item = pair_items.get(key)
+        if key not in pair_ids and (item is None or item.get('statusCode') != 200) :
+            print('Error1 No route returned for trip {}'.format(trip))
+            failed_keys.add(key)
+            continue
         
-        # Send the POST request 
-        try :
-            # Request the response from Azure maps
-            response = requests.request("POST", api_url, headers=headers, data=json.dumps(payload))
-            # checking the status code of the request
-            if response.status_code == 200:
-                # Convert json to python dictionary
-                response_data = json.loads(response.text)
-                print("Successful HTTP request")
-            else:   
-                raise Exception('Error in the HTTP request')
-        except Exception as e:
-            print('Error1' + str(e))     
-            
-        # Grab the route data recieved frm Azure Maps 
-        route = response_data
-        # Write Azure maps data to MongoDB & return the ID
-        print('Writing data to Cosmos DB...\n')
-        route_id = collection.insert_one(route).inserted_id
+        if key in pair_ids :
+            # Reuse the document already saved for this start & end pair
+            route_id = pair_ids[key]
+        else :
+            # Wrap the batch item as a single item batch response so that each
+            # route is saved as its own document
+            route = {'batchItems': [item], 'summary': {'successfulRequests': 1, 'totalRequests': 1}}
+            # Queue Azure maps data for writing to MongoDB & keep its position,
+            # positions count up from 0 & Add may flush before it returns
+            position_keys[len(position_keys)] = key
+            route_id = writer.Add(route)
+            pair_ids[key] = route_id
                      
         # Collect log data
         dead_unique_id.append(trip_vec[trip - 1])
@@ -235,6 +653,18 @@ def getRouteInfo (trip_vec, start_vec, end_vec, api_url, dead_loc, collection, c
         end_lat.append(coords.end_stop_lat)
         end_lon.append(coords.end_stop_lon)
         
+    # Write any remaining routes & swap positions for the saved IDs, dropping
+    # trips whose route could not be saved. Journaled routes already hold
+    # their saved ID.
+    print('Writing data to Cosmos DB...\n')
+    saved_ids = writer.Close()
+    object_id = [saved_ids[position] if isinstance(position, int) else position for position in object_id]
+    if journal is not None :
+        journal.Record(stage, [(key, None) for key in failed_keys], 'failed')
+        print('Journal {}: {}'.format(stage, journal.Stats(stage)))
+    if len(failed_keys) != 0 :
+        raise Exception('No route saved for {} {} start & end pairs, rerun to retry them'.format(len(failed_keys), dead_loc))
+    
     # Create a data frame of log output
     dead_route_log_df = pd.DataFrame(object_id, columns = ['object_id'])
     dead_route_log_df['dead_unique_id'] = dead_unique_id
@@ -245,10 +675,107 @@ def getRouteInfo (trip_vec, start_vec, end_vec, api_url, dead_loc, collection, c
     dead_route_log_df['end_lon'] = end_lon
        
     # Convert object_id to string
+    dead_route_log_df = dead_route_log_df[dead_route_log_df['object_id'].notna()].reset_index(drop = True)
     dead_route_log_df['object_id'] = dead_route_log_df['object_id'].astype(str)
         
     return(dead_route_log_df)
 
+# Create a class for archiving raw Azure Maps batch items in the background
+# while routes are tabulated straight into the shapes tables. Items are
+# queued & written by a single thread, either as lines of a gzip compressed
+# JSONL file or as documents in a Cosmos collection, so the archive never
+# holds up the pipeline.
+class routeArchive:
+  def __init__(self, filepath = None, collection = None, flush_size = 500):
+    if (filepath is None) == (collection is None) :
+      raise Exception('Pass either an archive file path or a Cosmos collection')
+    self.filepath = filepath
+    self.collection = collection
+    self.flush_size = flush_size
+    self.archived = 0
+    self.error = None
+    self.queue = queue.Queue(maxsize = 10000)
+    self.thread = threading.Thread(target = self.run, daemon = True)
+    self.thread.start()
+
+  # Queue a record while the writer thread is alive, once it has died
+  # nothing would take records off a full queue so they are dropped &
+  # the error is raised by close
+  def enqueue(self, record):
+    while self.thread.is_alive() :
+      try :
+        self.queue.put(record, timeout = 1)
+        return(True)
+      except queue.Full :
+        continue
+    return(False)
+
+  # Queue a batch item for archiving
+  def put(self, dead_loc, key, item):
+    self.enqueue((dead_loc, key, item))
+
+  # Write queued items until close is called, keeping any error for close
+  def run(self):
+    try :
+      if self.filepath is not None :
+        archive_file = gzip.open(self.filepath, 'at', encoding = 'utf8')
+      else :
+        writer = loadPackage('mongoWriter').BulkMongoWriter(self.collection, self.flush_size)
+      while True :
+        record = self.queue.get()
+        if record is None :
+          break
+        dead_loc, key, item = record
+        if self.filepath is not None :
+          archive_file.write(json.dumps({'dead_loc': dead_loc, 'route_key': key, 'item': item}) + '\n')
+        else :
+          writer.Add({'batchItems': [item], 'summary': {'successfulRequests': 1, 'totalRequests': 1},
+                      'dead_loc': dead_loc, 'route_key': key})
+        self.archived += 1
+      if self.filepath is not None :
+        archive_file.close()
+      else :
+        writer.Close()
+    except Exception as e :
+      print('Route archive failed after {} routes: {}'.format(self.archived, e))
+      self.error = e
+
+  # Wait for the queue to drain & close the archive, raising the error
+  # the writer thread stopped on if there was one
+  def close(self):
+    self.enqueue(None)
+    self.thread.join()
+    if self.error is not None :
+      raise self.error
+    print('{} routes archived'.format(self.archived))
+
+
+# Function for streaming the route of every dead trip/leg from Azure Maps
+# straight into shapes table chunks, skipping the write to Cosmos DB & the
+# read back in Step 4. The chunks have the same columns & row order as
+# iterRouteInfo. A routeArchive can be passed in to keep the raw batch items.
+def streamRouteInfo (trip_vec, start_vec, end_vec, api_url, dead_loc, connection, mode = 'stops', resolver = None, cache = None, budget = None, archive = None, chunk_rows = 100000):
+    resolved = resolveRouteItems(trip_vec, start_vec, end_vec, api_url, connection, mode, resolver, cache, budget)
+    if resolved is None :
+        return
+    all_coords, trip_keys, pair_items = resolved
+    
+    def routeItems () :
+        archived = set()
+        for count, trip in enumerate(trip_vec) :
+            key = trip_keys[count]
+            item = pair_items[key]
+            if item is None or item.get('statusCode') != 200 :
+                print('Error1 No route returned for trip {}'.format(trip))
+                continue
+            if archive is not None and key not in archived :
+                archive.put(dead_loc, key, item)
+                archived.add(key)
+            yield([count], item['response']['routes'][0])
+    
+    yield from tabulateRoutes(routeItems(), trip_vec, chunk_rows)
+
+
 # Create a simple function for adding an index to an SQL DB
 def createIndex (col, table, connection, curs) :
     query = "SELECT * FROM sys.indexes WHERE name='idx_{}' AND object_id = OBJECT_ID('dbo.{}')".format(col, table)
@@ -261,4 +788,121 @@ def createIndex (col, table, connection, curs) :
     else :
         print('Index aleady exists, nothing to be done...')
 
-        
+
+# Create a function to load the index manifest file. The manifest lists the
+# indexes to build after each pipeline step, each with a table, name, key
+# columns & optionally INCLUDE columns & older index names it replaces.
+def loadIndexManifest (filepath) :
+    with open(filepath) as json_file :
+        return(json.load(json_file))
+
+
+# Create a function to read every existing named index with one catalog query.
+# Returns a dict of (table, index) -> (key columns, included columns) and the
+# set of existing tables.
+def getExistingIndexes (connection) :
+    query = """SELECT t.name AS table_name, i.name AS index_name, c.name AS column_name,
+                      ic.key_ordinal, ic.is_included_column
+               FROM sys.tables t
+               LEFT JOIN sys.indexes i ON i.object_id = t.object_id AND i.name IS NOT NULL
+               LEFT JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+               LEFT JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+               ORDER BY t.name, i.name, ic.key_ordinal"""
+    catalog = pd.read_sql_query(query, connection)
+    tables = set(catalog['table_name'])
+    existing = {}
+    for (table, name), cols in catalog.dropna(subset = ['index_name']).groupby(['table_name', 'index_name']) :
+        key_cols = tuple(cols['column_name'][~cols['is_included_column'].astype(bool)])
+        include_cols = frozenset(cols['column_name'][cols['is_included_column'].astype(bool)])
+        existing[(table, name)] = (key_cols, include_cols)
+    return(existing, tables)
+
+
+# Create a function to build the indexes listed in the manifest for a step.
+# Existing indexes are checked with one catalog query & everything that needs
+# doing is sent as a single batch which reports the build time of each index.
+def applyIndexManifest (step, manifest, connection) :
+    existing, tables = getExistingIndexes(connection)
+    statements = []
+    for index in manifest.get(step, []) :
+        table, name = index['table'], index['name']
+        if table not in tables :
+            print("Table '{}' not found, skipping index '{}'".format(table, name))
+            continue
+        drops = [old for old in index.get('replaces', []) if (table, old) in existing]
+        wanted = (tuple(index['columns']), frozenset(index.get('include', [])))
+        if existing.get((table, name)) == wanted and len(drops) == 0 :
+            print("Index '{}' on '{}' already exists, nothing to be done...".format(name, table))
+            continue
+        if (table, name) in existing and name not in drops :
+            drops.append(name)
+        sql = ''.join('DROP INDEX [{0}] ON [{1}]; '.format(old, table) for old in drops)
+        sql += 'CREATE INDEX [{0}] ON [{1}] ({2})'.format(name, table, ', '.join('[{}]'.format(c) for c in index['columns']))
+        if len(index.get('include', [])) != 0 :
+            sql += ' INCLUDE ({})'.format(', '.join('[{}]'.format(c) for c in index['include']))
+        statements.append((table, name, sql))
+    
+    if len(statements) == 0 :
+        return(None)
+    
+    # Time each index inside the batch & catch any failures so that one bad
+    # index does not stop the rest being built
+    batch = ['SET NOCOUNT ON;',
+             'DECLARE @timings TABLE (table_name NVARCHAR(256), index_name NVARCHAR(256), ms INT, error NVARCHAR(4000));',
+             'DECLARE @t DATETIME2;']
+    for table, name, sql in statements :
+        batch.append("""SET @t = SYSDATETIME();
+BEGIN TRY
+    {2};
+    INSERT INTO @timings VALUES ('{0}', '{1}', DATEDIFF(ms, @t, SYSDATETIME()), NULL);
+END TRY
+BEGIN CATCH
+    INSERT INTO @timings VALUES ('{0}', '{1}', NULL, ERROR_MESSAGE());
+END CATCH;""".format(table, name, sql))
+    batch.append('SELECT table_name, index_name, ms, error FROM @timings;')
+    
+    print('Creating {} indexes for {}...'.format(len(statements), step))
+    curs = connection.cursor()
+    curs.execute('\n'.join(batch))
+    timings = pd.DataFrame.from_records(curs.fetchall(), columns = ['table_name', 'index_name', 'ms', 'error'])
+    curs.close()
+    for row in timings.itertuples() :
+        if row.error is None :
+            print("Index '{}' on '{}' built in {}s".format(row.index_name, row.table_name, round(row.ms / 1000, 1)))
+        else :
+            print("Index '{}' on '{}' failed: {}".format(row.index_name, row.table_name, row.error))
+    return(timings)
+
+
+
+# Create a function to fingerprint a table on the server, so that the pipeline
+# can tell if a table has changed without reading it. Only catalog views are
+# read, never the table itself: the object id & create date change whenever a
+# table is replaced (a BulkLoader swap or an R overwrite), the modify date on
+# any schema change, the row count comes from the partition stats & the last
+# user update catches rows changed in place. The server clears the last user
+# update when it restarts, which at worst reruns a step that was unchanged.
+# Returns a string, or None if the table does not exist.
+def tableFingerprint (table, connection) :
+    curs = connection.cursor()
+    curs.execute("SELECT OBJECT_ID(?, 'U')", table)
+    object_id = curs.fetchone()[0]
+    if object_id is None :
+        curs.close()
+        return(None)
+    try :
+        curs.execute("""SELECT o.create_date, o.modify_date,
+                               (SELECT SUM(ps.row_count) FROM sys.dm_db_partition_stats ps
+                                WHERE ps.object_id = o.object_id AND ps.index_id IN (0, 1)),
+                               (SELECT MAX(us.last_user_update) FROM sys.dm_db_index_usage_stats us
+                                WHERE us.database_id = DB_ID() AND us.object_id = o.object_id)
+                        FROM sys.objects o WHERE o.object_id = ?""", object_id)
+    except Exception :
+        # The dynamic management views need VIEW DATABASE STATE, without it
+        # the rows are counted from the smallest index instead
+        curs.execute("""SELECT o.create_date, o.modify_date,
+                               (SELECT COUNT_BIG(*) FROM [{}]), NULL
+                        FROM sys.objects o WHERE o.object_id = ?""".format(table), object_id)
+    created, modified, count, updated = curs.fetchone()
+    curs.close()
+    return('{}:{}:{}:{}:{}'.format(object_id, created, modified, count, updated))
@@ -11,10 +11,15 @@
 # the end and starting point of two successive trips.
 
 import pandas as pd
-from pymongo import MongoClient
+import threading
 import importlib.util
 
-def run_all_ingr (keys, connection, conn_string) :
+# In direct mode the routes are tabulated straight into the dead_trip_routes &
+# dead_leg_routes tables as they arrive from Azure Maps, so Step 4 is not
+# needed. The raw responses are archived in the background to a gzip JSONL
+# file (archive = 'jsonl'), to Cosmos DB (archive = 'cosmos') or not at all
+# (archive = None).
+def run_all_ingr (keys, connection, conn_string, route_cache_file = 'route_cache.sqlite', direct = False, archive = 'jsonl', archive_file = 'route_archive.jsonl.gz') :
 
     # Load common function file
     spec = importlib.util.spec_from_file_location("functions", "C:/MyApps/dapTbElectricDublinBus/_pipeline/functions.py")
@@ -28,7 +33,9 @@ def run_all_ingr (keys, connection, conn_string) :
     # Azure Cosmos DB service implements wire protocols for common NoSQL APIs including Cassandra, MongoDB. 
     # This allows you to use your familiar NoSQL client drivers and tools to interact with your Cosmos database.
     uri = "mongodb://electric-bus-cosmos-east-us:" + keys.cosmos_key + "@electric-bus-cosmos-east-us.mongo.cosmos.azure.com:10255/?ssl=true&retrywrites=false&replicaSet=globaldb&maxIdleTimeMS=120000&appName=@electric-bus-cosmos-east-us@"
-    client = MongoClient(uri)
+    # Borrow the shared client so the connection is reused across steps
+    pool = functs.loadPackage('resourcePool').GetPool()
+    client = pool.MongoClient(uri)
     # Create database
     db = client['bus_routes_nosql']
     # Create collection for route data
@@ -44,51 +51,132 @@ def run_all_ingr (keys, connection, conn_string) :
                             + '&subscription-key=' + keys.maps_sub_key + '&traffic=' + check_traffic
     
     #%%
-    # Focus on Dead TRIPs
-    # ===================
-    # Get the stop analysis data from the database and drop duplicates so that 
-    # We only have unique dead trips    
-    dead_trips = pd.read_sql_query('SELECT * FROM stop_analysis', connection)
-    dead_trips_unique = dead_trips[['dead_trip_unique_id', 'trip_first_stop_id', 'trip_last_stop_id']].drop_duplicates()
-    # Reset the index after dropping rows
-    dead_trips_unique = dead_trips_unique.reset_index()    
+    # Load stop & depot coordinates once for both the dead trips & dead legs
+    resolver = functs.coordResolver(connection)
     
-    #%%
-    # Now get Dead TRIP route data & create table of log info
-    dead_trip_log_df = functs.getRouteInfo(
-        trip_vec = dead_trips_unique['dead_trip_unique_id'], 
-        start_vec = dead_trips_unique['trip_first_stop_id'], 
-        end_vec = dead_trips_unique['trip_last_stop_id'], 
-        api_url = route_api_url, 
-        dead_loc = 'trip',
-        collection = routes,
-        connection = connection,
-        mode = 'stops'
+    # Open the local route cache, routes with the same start & end points as
+    # an earlier run are served from here rather than Azure Maps
+    cache = functs.routeCache(
+        filepath = route_cache_file, 
+        api_version = api_version, 
+        traffic = check_traffic
         )
     
     #%%
-    # Focus on Dead LEGs
-    # ===================
-    # First get log info from Azure SQL db
-    query = 'SELECT * FROM dead_leg_summary'   
-    dead_legs = pd.read_sql_query(query, connection)
-    dead_legs_unique = dead_legs[['dead_leg_unique_id', 'start', 'end']].drop_duplicates()
-    # Reset the index after dropping rows
-    dead_legs_unique = dead_legs_unique.reset_index()
+    # Get the unique dead trips from the stop analysis data & the unique dead
+    # legs from the dead leg summary, the database drops the duplicates so
+    # only the unique rows are transferred
+    query = """SELECT DISTINCT dead_trip_unique_id, trip_first_stop_id, trip_last_stop_id 
+               FROM stop_analysis ORDER BY dead_trip_unique_id"""
+    dead_trips_unique = pd.read_sql_query(query, connection)
+    query = """SELECT DISTINCT dead_leg_unique_id, [start], [end] 
+               FROM dead_leg_summary ORDER BY dead_leg_unique_id"""
+    dead_legs_unique = pd.read_sql_query(query, connection)
+    functs.metrics().Count('rows_read', len(dead_trips_unique.index) + len(dead_legs_unique.index))
     del query
     
     #%%
-    # Now get the dead LEG route data & create table of log info
-    dead_leg_log_df = functs.getRouteInfo(
-        trip_vec = dead_legs_unique['dead_leg_unique_id'], 
-        start_vec = dead_legs_unique['start'], 
-        end_vec = dead_legs_unique['end'], 
-        api_url = route_api_url, 
-        dead_loc = 'leg',
-        collection = routes,
-        connection = connection,
-        mode = 'legs'
-        )
+    # Get Dead TRIP & Dead LEG route data at the same time
+    # ====================================================
+    # The two phases are independent & mostly wait on Azure Maps & Cosmos DB,
+    # so they run side by side. Both draw on one budget of in-flight Azure
+    # Maps requests so running them together does not double the load.
+    budget = threading.BoundedSemaphore(functs.maps_max_concurrent)
+    
+    if direct :
+        #%%
+        # Stream Dead TRIP & Dead LEG routes straight to the route tables
+        # ================================================================
+        if archive == 'jsonl' :
+            route_archive = functs.routeArchive(filepath = archive_file)
+        elif archive == 'cosmos' :
+            route_archive = functs.routeArchive(collection = routes)
+        else :
+            route_archive = None
+        engine = pool.SQLEngine(conn_string)
+        
+        def streamShapes (table, view, trip_vec, start_vec, end_vec, dead_loc, mode) :
+            return(lambda: functs.saveRouteShapes(
+                table = table,
+                view = view,
+                chunks = functs.streamRouteInfo(
+                    trip_vec = trip_vec, 
+                    start_vec = start_vec, 
+                    end_vec = end_vec, 
+                    api_url = route_api_url, 
+                    dead_loc = dead_loc,
+                    connection = connection,
+                    mode = mode,
+                    resolver = resolver,
+                    cache = cache,
+                    budget = budget,
+                    archive = route_archive
+                    ),
+                eng = engine
+                ))
+        
+        try :
+            functs.runConcurrently({
+                'dead_trip_routes': streamShapes('dead_trip_routes', 'dead_trip_shapes', dead_trips_unique['dead_trip_unique_id'], 
+                                                 dead_trips_unique['trip_first_stop_id'], 
+                                                 dead_trips_unique['trip_last_stop_id'], 'trip', 'stops'),
+                'dead_leg_routes': streamShapes('dead_leg_routes', 'dead_leg_shapes', dead_legs_unique['dead_leg_unique_id'], 
+                                                dead_legs_unique['start'], 
+                                                dead_legs_unique['end'], 'leg', 'legs')
+                })
+        finally :
+            print('Route cache: {} hits, {} misses'.format(cache.hits, cache.misses))
+            cache.close()
+            # Closed last as it raises the error the archive stopped on
+            if route_archive is not None :
+                route_archive.close()
+        return(None)
+    
+    # Routes saved to Cosmos are journaled as they are written, so restarting
+    # an interrupted run with the same run id only requests what is left
+    journal = functs.loadPackage('checkpointJournal').GetJournal()
+    
+    def deadTrips () :
+        return(functs.getRouteInfo(
+            trip_vec = dead_trips_unique['dead_trip_unique_id'], 
+            start_vec = dead_trips_unique['trip_first_stop_id'], 
+            end_vec = dead_trips_unique['trip_last_stop_id'], 
+            api_url = route_api_url, 
+            dead_loc = 'trip',
+            collection = routes,
+            connection = connection,
+            mode = 'stops',
+            resolver = resolver,
+            cache = cache,
+            budget = budget,
+            journal = journal
+            ))
+    
+    def deadLegs () :
+        return(functs.getRouteInfo(
+            trip_vec = dead_legs_unique['dead_leg_unique_id'], 
+            start_vec = dead_legs_unique['start'], 
+            end_vec = dead_legs_unique['end'], 
+            api_url = route_api_url, 
+            dead_loc = 'leg',
+            collection = routes,
+            connection = connection,
+            mode = 'legs',
+            resolver = resolver,
+            cache = cache,
+            budget = budget,
+            journal = journal
+            ))
+    
+    # A phase with failed routes raises after saving the rest, leaving the
+    # logs unsaved so the step reruns & picks up its journaled routes
+    try :
+        logs = functs.runConcurrently({'dead_trip': deadTrips, 'dead_leg': deadLegs})
+    finally :
+        print('Route cache: {} hits, {} misses'.format(cache.hits, cache.misses))
+        cache.close()
+    dead_trip_log_df = logs['dead_trip']
+    dead_leg_log_df = logs['dead_leg']
     
     #%%
     # Review Log Tables
@@ -105,26 +193,13 @@ def run_all_ingr (keys, connection, conn_string) :
     # Logs relate object id to specific dead trips / legs
     # Create code to write a pandas dataframe to SQL table
     # Using a similar method to dbWriteTable in R
-    from sqlalchemy import create_engine
-    from urllib.parse import quote_plus
-    
-    quoted = quote_plus(conn_string)
-    new_con = 'mssql+pyodbc:///?odbc_connect={}'.format(quoted)
-    engine = create_engine(new_con,  fast_executemany = True)
+    engine = pool.SQLEngine(conn_string)
     
-    # Save Dead TRIP log to Azure SQL db
-    functs.saveLogInfo(
-        table = 'dead_trip_log', 
-        df = dead_trip_log_df,
-        eng = engine
-        )
-    
-    # Save Dead TRIP log to Azure SQL db
-    functs.saveLogInfo(
-        table = 'dead_leg_log', 
-        df = dead_leg_log_df,
-        eng = engine
-        )
+    # Save the Dead TRIP & Dead LEG logs to Azure SQL db together
+    functs.runConcurrently({
+        'dead_trip_log': lambda: functs.saveLogInfo(table = 'dead_trip_log', df = dead_trip_log_df, eng = engine),
+        'dead_leg_log': lambda: functs.saveLogInfo(table = 'dead_leg_log', df = dead_leg_log_df, eng = engine)
+        })
 
 if __name__ == '__main__':
     # when executed as script, run this function
@@ -3,21 +3,29 @@ import pyodbc
 import pandas as pd
 import urllib
 import pymongo
+from _pipeline.pypackages.bulkLoader import BulkLoader
+from _pipeline.pypackages.resourcePool import GetPool
+from _pipeline.pypackages.mongoWriter import BulkMongoWriter
 
 
 class Azure():
     """Connect to Azure for multiple servers"""
     def __init__(self,in_config):
         self.in_config = in_config
+        self.pool = GetPool(in_config.poolSize, in_config.poolIdleTimeout)
     def __call__(self, *args):
         if args[0] == "UploadToSQL":
             return self.UploadToSQL(args[1], args[2], args[3])
+        elif args[0] == "AppendToSQL":
+            return self.AppendToSQL(args[1], args[2], args[3])
         elif args[0] == "SelectDistinct":
             return self.SelectDistinct(args[1], args[2])
         elif args[0] == "SelectLongLat":
             return self.SelectLongLat(args[1],args[2],args[3],args[4])
         elif args[0] == "UploadToMongo":
             return self.UploadToMongo(args[1],args[2])
+        elif args[0] == "UploadManyToMongo":
+            return self.UploadManyToMongo(args[1],args[2])
         elif args[0] == "SelectFromMongo":
             return self.SelectFromMongo()
         elif args[0] == "AzureDBConn":
@@ -28,15 +36,25 @@ class Azure():
             return self.dropMongoColl(args[1])
         elif args[0] == "SelectAllData":
             return self.SelectAllData(args[1])
+        elif args[0] == "SelectData":
+            return self.SelectData(*args[1:])
+        elif args[0] == "PoolCounters":
+            return self.pool.Counters()
         else:
             return "Object does not exist."
 
     def AzureDBConn(self, connStr):
-        """Connect to SQL database simple.
+        """Connect to SQL database simple, closing the
+           connection returns it to the shared pool.
            Requires: connection string."""
-        conn = pyodbc.connect(connStr)
+        conn = self.pool.SQLEngine(connStr).raw_connection()
         return conn
 
+    def AzureDBEngine(self, connStr):
+        """Return the shared SQLAlchemy engine for a database.
+           Requires: connection string."""
+        return self.pool.SQLEngine(connStr)
+
     def AzureDBEng(self, conn):
         """Connect to SQL database for pandas to_sql command.
            Requires: connection string.
@@ -46,19 +64,29 @@ class Azure():
         return Eng 
     
     def AzureMongoConn(self):
-        """Connect to MongoDB.
+        """Return the shared MongoDB client.
            **Not Callable outside of Azure()**"""
         uri = self.in_config.MongoQuote
-        client = pymongo.MongoClient(uri)
+        client = self.pool.MongoClient(uri)
         return client
 
     def UploadToSQL(self, df, tablename, conn):
-        """Upload data dataframe to SQL.
+        """Upload data dataframe to SQL, replacing the table
+           once all rows are written.
            Requires: Dataframe, new table name 
            and SQL connection"""
 
-        conn = self.AzureDBEng(conn)
-        df.to_sql(tablename, conn, if_exists="replace")
+        eng = self.AzureDBEngine(conn)
+        return BulkLoader(eng).Load(tablename, df)
+
+    def AppendToSQL(self, df, tablename, conn):
+        """Append dataframe rows to an SQL table, creating
+           the table if it does not exist.
+           Requires: Dataframe, table name 
+           and SQL connection"""
+
+        eng = self.AzureDBEngine(conn)
+        return BulkLoader(eng).Append(tablename, df)
 
     def UploadToMongo(self, collection, MongoData):
         """Upload files to MongoDB.
@@ -69,8 +97,19 @@ class Azure():
         mycol = mydb[collection]
         mydict = MongoData
         mycol.insert_one(mydict)
-        client.close()
     
+    def UploadManyToMongo(self, collection, MongoData):
+        """Upload many files to MongoDB in bulk.
+           Requires: collection name and list of Json
+           files to upload to MongoDB. Returns the ids
+           in input order, None for any that failed."""
+        client = self.AzureMongoConn()
+        mydb = client[self.in_config.MongoDB]
+        writer = BulkMongoWriter(mydb[collection], self.in_config.MongoFlushSize)
+        for mydict in MongoData:
+            writer.Add(mydict)
+        return writer.Close()
+
     def DropMongoColl(self, collection):
         """Drop MongoDB collection by collection name.
            Requires: collection name."""
@@ -78,7 +117,6 @@ class Azure():
         mydb = client[self.in_config.MongoDB]
         mycol = mydb[collection]
         mycol.drop()
-        client.close()
 
     def SelectFromMongo(self):
         """Return all docuements in the MongoDB'shapes' 
@@ -86,7 +124,6 @@ class Azure():
         client = self.AzureMongoConn()
         db = client.shapes
         collection = db.shapes
-        client.close()
         return collection
     
     def CreateMongoColl(self, newDB):
@@ -95,29 +132,64 @@ class Azure():
         client = self.AzureMongoConn()
         mydb = client[self.in_config.MongoDB]
         mycol = mydb[newDB]
-        client.close()
     
     def SQLDrop(self, tablename):
         """Drop SQL schema from the specified database"""
-        conn = self.AzureDBConn(self.in_config.teamConnQuote)
         SQLString = self.in_config.SQLDrop.format(tablename)
-        conn.execute(SQLString)
-        conn.close()
+        with self.AzureDBEngine(self.in_config.teamConnQuote).begin() as conn:
+            conn.exec_driver_sql(SQLString)
     
     def SelectDistinct(self, column, tablename):
         """Select unique items in a database schema."""
-        conn = self.AzureDBConn(self.in_config.teamConnQuote)
         SQLString = self.in_config.SQLDistinct.format(column, tablename)
-        df = pd.read_sql(SQLString, conn)
-        conn.close()
+        df = pd.read_sql(SQLString, self.AzureDBEngine(self.in_config.teamConnQuote))
         return df
     
     def SelectAllData(self, tablename):
         """Return all data from a database Schema"""
-        conn = self.AzureDBConn(self.in_config.teamConnQuote)
-        SQLString = self.in_config.SQLSelect.format(tablename)
-        df = pd.read_sql(SQLString, conn)
-        conn.close()
+        return self.SelectData(tablename)
+
+    def SelectData(self, tablename, columns=None, where=None, params=None,
+                   distinct=False, chunksize=None, compact=False):
+        """Return data from a database schema, with the column
+           selection, filtering and de-duplication done by the database.
+           Requires: table name. Optional: list of columns, WHERE
+           clause with ? placeholders and its params, DISTINCT, chunk
+           size to return an iterator of dataframes and compact
+           dtypes."""
+        if columns:
+            columnString = ", ".join("[{}]".format(c) for c in columns)
+        else:
+            columnString = "*"
+        SQLString = self.in_config.SQLSelectColumns.format(
+            "DISTINCT " if distinct else "", columnString, tablename)
+        if where:
+            SQLString = SQLString + " WHERE " + where
+        eng = self.AzureDBEngine(self.in_config.teamConnQuote)
+        # SQLAlchemy only takes positional parameters as a tuple
+        params = tuple(params) if params is not None else None
+        if chunksize:
+            chunks = pd.read_sql(SQLString, eng, params=params, chunksize=chunksize)
+            if compact:
+                return (self.CompactTypes(df) for df in chunks)
+            return chunks
+        df = pd.read_sql(SQLString, eng, params=params)
+        if compact:
+            df = self.CompactTypes(df)
+        return df
+
+    def CompactTypes(self, df):
+        """Shrink dataframe dtypes, id and other repeated text columns
+           become categorical and integers the smallest type that fits.
+           Floats are left as float64, coordinates are compared and
+           joined on and float32 would round them to about a metre."""
+        for column in df.columns:
+            series = df[column]
+            if pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+                if column.endswith("_id") or series.nunique() < 0.5 * len(series):
+                    df[column] = series.astype("category")
+            elif pd.api.types.is_integer_dtype(series):
+                df[column] = pd.to_numeric(series, downcast="integer")
         return df
     
 
@@ -0,0 +1,248 @@
+import time
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, inspect, types
+
+
+class BulkLoader():
+    """Load dataframes into SQL through a staging table that is
+       swapped into place once it is fully written, so readers
+       never see a half written table."""
+    # Longest NVARCHAR SQL Server allows before NVARCHAR(MAX)
+    maxUnicodeLength = 4000
+
+    def __init__(self, eng, chunksize=10000):
+        self.eng = eng
+        self.chunksize = chunksize
+        self.stats = []
+
+    def __call__(self, *args):
+        if args[0] == "Load":
+            return self.Load(args[1], args[2])
+        elif args[0] == "LoadTyped":
+            return self.Load(args[1], args[2], args[3])
+        elif args[0] == "Append":
+            return self.Append(args[1], args[2])
+        else:
+            return "Object does not exist."
+
+    def Quote(self, name):
+        """Quote a table or column name for the engine's dialect.
+           **Not Callable outside of BulkLoader()**"""
+        return self.eng.dialect.identifier_preparer.quote(name)
+
+    def SQLTypes(self, df, dtype=None):
+        """Map dataframe columns to explicit SQL types, any types
+           passed in dtype take precedence.
+           **Not Callable outside of BulkLoader()**"""
+        sqlTypes = {}
+        for column in df.columns:
+            series = df[column]
+            if dtype and column in dtype:
+                continue
+            elif pd.api.types.is_bool_dtype(series):
+                sqlTypes[column] = types.Boolean()
+            elif pd.api.types.is_integer_dtype(series):
+                sqlTypes[column] = types.BigInteger()
+            elif pd.api.types.is_float_dtype(series):
+                sqlTypes[column] = types.Float(precision=53)
+            elif pd.api.types.is_datetime64_any_dtype(series):
+                sqlTypes[column] = types.DateTime()
+            else:
+                # Leave headroom for longer strings in later chunks, Widen
+                # makes room if a later chunk still goes past it
+                sqlTypes[column] = self.UnicodeType(max(255, 2 * self.MaxLength(series)))
+        if dtype:
+            sqlTypes.update(dtype)
+        return sqlTypes
+
+    def MaxLength(self, series):
+        """Return the length of the longest value of a column as text.
+           **Not Callable outside of BulkLoader()**"""
+        maxLength = series.astype(str).str.len().max()
+        return 0 if pd.isna(maxLength) else int(maxLength)
+
+    def UnicodeType(self, length):
+        """Return an NVARCHAR type of a length, or NVARCHAR(MAX) past the
+           longest SQL Server allows.
+           **Not Callable outside of BulkLoader()**"""
+        if length > self.maxUnicodeLength:
+            return types.Unicode()
+        return types.Unicode(length=int(length))
+
+    def Widen(self, tablename, chunk, sqlTypes):
+        """Widen the text columns of a table that a chunk has longer
+           values for than the first chunk did, so later chunks are never
+           truncated or rejected. Returns the updated column types.
+           **Not Callable outside of BulkLoader()**"""
+        widened = {}
+        for column, sqlType in sqlTypes.items():
+            if not isinstance(sqlType, types.Unicode) or sqlType.length is None or column not in chunk.columns:
+                continue
+            maxLength = self.MaxLength(chunk[column])
+            if maxLength > sqlType.length:
+                widened[column] = self.UnicodeType(2 * maxLength)
+        # SQLite does not enforce text lengths
+        if len(widened) == 0 or self.eng.dialect.name == "sqlite":
+            return dict(sqlTypes, **widened)
+        with self.eng.begin() as conn:
+            for column, sqlType in widened.items():
+                typeSQL = sqlType.compile(dialect=self.eng.dialect)
+                if self.eng.dialect.name == "mssql":
+                    conn.exec_driver_sql("ALTER TABLE {0} ALTER COLUMN {1} {2} NULL".format(
+                        self.Quote(tablename), self.Quote(column), typeSQL))
+                else:
+                    conn.exec_driver_sql("ALTER TABLE {0} ALTER COLUMN {1} TYPE {2}".format(
+                        self.Quote(tablename), self.Quote(column), typeSQL))
+                print(f"Widened {tablename}.{column} to {typeSQL}")
+        return dict(sqlTypes, **widened)
+
+    def ColumnValues(self, series):
+        """Convert a column to a list of python values with None
+           for missing values.
+           **Not Callable outside of BulkLoader()**"""
+        if pd.api.types.is_datetime64_any_dtype(series):
+            values = series.dt.to_pydatetime().astype(object)
+        else:
+            values = series.to_numpy()
+        if series.isna().any():
+            values = np.where(series.isna().to_numpy(), None, values.astype(object))
+        return values.tolist()
+
+    def InsertChunk(self, cursor, tablename, df):
+        """Insert a dataframe into a table with executemany, rows are
+           built column by column rather than row by row.
+           **Not Callable outside of BulkLoader()**"""
+        columns = ", ".join(self.Quote(c) for c in df.columns)
+        markers = ", ".join(["?"] * len(df.columns))
+        SQLString = "INSERT INTO {0} ({1}) VALUES ({2})".format(self.Quote(tablename), columns, markers)
+        for start in range(0, len(df.index), self.chunksize):
+            part = df.iloc[start:start + self.chunksize]
+            rows = list(zip(*[self.ColumnValues(part[c]) for c in part.columns]))
+            cursor.executemany(SQLString, rows)
+
+    def DropTable(self, conn, tablename):
+        """Drop a table if it exists.
+           **Not Callable outside of BulkLoader()**"""
+        if self.eng.dialect.name == "mssql":
+            conn.exec_driver_sql("IF OBJECT_ID(N'dbo.{0}', N'U') IS NOT NULL DROP TABLE {1}".format(tablename, self.Quote(tablename)))
+        else:
+            conn.exec_driver_sql("DROP TABLE IF EXISTS {0}".format(self.Quote(tablename)))
+
+    def Swap(self, staging, tablename):
+        """Replace a table with its staging table in one transaction.
+           **Not Callable outside of BulkLoader()**"""
+        with self.eng.begin() as conn:
+            self.DropTable(conn, tablename)
+            if self.eng.dialect.name == "mssql":
+                conn.exec_driver_sql("EXEC sp_rename 'dbo.{0}', '{1}'".format(staging, tablename))
+            else:
+                conn.exec_driver_sql("ALTER TABLE {0} RENAME TO {1}".format(self.Quote(staging), self.Quote(tablename)))
+
+    def TableExists(self, tablename):
+        """Check whether a table exists.
+           **Not Callable outside of BulkLoader()**"""
+        return inspect(self.eng).has_table(tablename)
+
+    def Append(self, tablename, df, dtype=None):
+        """Append a dataframe to a table, the rows are written to a
+           staging table first and copied across in one transaction.
+           Creates the table if it does not exist.
+           Requires: table name and dataframe."""
+        if not self.TableExists(tablename):
+            return self.Load(tablename, df, dtype)
+        if len(df.index) == 0:
+            print(f"No rows to append to {tablename}.")
+            return None
+        start = time.time()
+        staging = tablename + "_staging"
+        with self.eng.begin() as conn:
+            self.DropTable(conn, staging)
+        df.head(0).to_sql(staging, self.eng, index=False, dtype=self.SQLTypes(df, dtype))
+        conn = self.eng.raw_connection()
+        try:
+            cursor = conn.cursor()
+            if hasattr(cursor, "fast_executemany"):
+                cursor.fast_executemany = True
+            self.InsertChunk(cursor, staging, df)
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+        columns = ", ".join(self.Quote(c) for c in df.columns)
+        with self.eng.begin() as conn:
+            conn.exec_driver_sql("INSERT INTO {0} ({1}) SELECT {1} FROM {2}".format(
+                self.Quote(tablename), columns, self.Quote(staging)))
+            self.DropTable(conn, staging)
+        seconds = time.time() - start
+        rows = len(df.index)
+        stats = {"table": tablename,
+                 "rows": rows,
+                 "seconds": round(seconds, 1),
+                 "rows_per_second": round(rows / seconds) if seconds > 0 else None}
+        self.stats.append(stats)
+        print(f"Appended {rows} rows to {tablename} in {stats['seconds']}s ({stats['rows_per_second']} rows/s)")
+        return stats
+
+    def Load(self, tablename, data, dtype=None):
+        """Replace a table with a dataframe, or with an iterable of
+           dataframe chunks which are written as they arrive.
+           Requires: table name and data. Returns the load stats."""
+        start = time.time()
+        staging = tablename + "_staging"
+        chunks = [data] if isinstance(data, pd.DataFrame) else data
+        rows = 0
+        created = False
+        sqlTypes = None
+        with self.eng.begin() as conn:
+            self.DropTable(conn, staging)
+        conn = self.eng.raw_connection()
+        try:
+            cursor = conn.cursor()
+            if hasattr(cursor, "fast_executemany"):
+                cursor.fast_executemany = True
+            for chunk in chunks:
+                if not created:
+                    # Create the staging table from the first chunk
+                    sqlTypes = self.SQLTypes(chunk, dtype)
+                    chunk.head(0).to_sql(staging, self.eng, index=False, dtype=sqlTypes)
+                    created = True
+                else:
+                    sqlTypes = self.Widen(staging, chunk, sqlTypes)
+                self.InsertChunk(cursor, staging, chunk)
+                conn.commit()
+                rows += len(chunk.index)
+                print(f"{rows} rows written to {staging}")
+            cursor.close()
+        finally:
+            conn.close()
+        if not created:
+            print(f"No data to load, {tablename} left unchanged.")
+            return None
+        self.Swap(staging, tablename)
+        seconds = time.time() - start
+        stats = {"table": tablename,
+                 "rows": rows,
+                 "seconds": round(seconds, 1),
+                 "rows_per_second": round(rows / seconds) if seconds > 0 else None}
+        self.stats.append(stats)
+        print(f"Loaded {rows} rows into {tablename} in {stats['seconds']}s ({stats['rows_per_second']} rows/s)")
+        return stats
+
+
+if __name__ == '__main__':
+    # Benchmark the loader against pandas to_sql on a local SQLite
+    # database, no Azure connection is needed.
+    import sys
+    nRows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    df = pd.DataFrame({"dead_trip_unique_id": np.repeat(np.arange(nRows // 200 + 1), 200)[:nRows],
+                       "latitude": np.random.uniform(53.2, 53.5, nRows),
+                       "longitude": np.random.uniform(-6.4, -6.1, nRows),
+                       "point_order": np.tile(np.arange(1, 201), nRows // 200 + 1)[:nRows],
+                       "distance_km": np.random.uniform(1, 20, nRows),
+                       "time_hrs": np.random.uniform(0.05, 1, nRows)})
+    eng = create_engine("sqlite:///bulk_loader_benchmark.sqlite")
+    start = time.time()
+    df.to_sql("benchmark_to_sql", eng, if_exists="replace", chunksize=10000, index=False)
+    print(f"pandas to_sql: {round(nRows / (time.time() - start))} rows/s")
+    BulkLoader(eng).Load("benchmark_bulk", df)
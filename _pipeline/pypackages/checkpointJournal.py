@@ -0,0 +1,104 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class CheckpointJournal():
+    """Durable per item progress of long collection steps, kept in a
+       local SQLite file keyed by run id, stage and item id. Items are
+       recorded as done, with their result, or failed as they finish, so
+       a run restarted with the same run id skips the items already done
+       and only retries the ones that failed or were never reached.
+       Without a run id a fresh one is made, so nothing is resumed."""
+    def __init__(self, filepath="checkpoint_journal.sqlite", runId=None):
+        self.runId = runId or time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filepath, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS items (
+                             run_id TEXT NOT NULL,
+                             stage TEXT NOT NULL,
+                             item_id TEXT NOT NULL,
+                             status TEXT NOT NULL,
+                             attempts INTEGER NOT NULL,
+                             result TEXT,
+                             updated REAL NOT NULL,
+                             PRIMARY KEY (run_id, stage, item_id))""")
+        self.db.commit()
+
+    def __call__(self, *args):
+        if args[0] == "Done":
+            return self.Done(args[1])
+        elif args[0] == "Pending":
+            return self.Pending(args[1], args[2])
+        elif args[0] == "Record":
+            return self.Record(*args[1:])
+        elif args[0] == "Stats":
+            return self.Stats(args[1])
+        elif args[0] == "Close":
+            return self.Close()
+        else:
+            return "Object does not exist."
+
+    def Done(self, stage):
+        """Return a dict of item id -> result for every item of a stage
+           already done in this run."""
+        with self.lock:
+            rows = self.db.execute("""SELECT item_id, result FROM items
+                                      WHERE run_id = ? AND stage = ? AND status = 'done'""",
+                                   (self.runId, stage)).fetchall()
+        return {itemId: None if result is None else json.loads(result) for itemId, result in rows}
+
+    def Pending(self, stage, itemIds):
+        """Return the item ids, in the order given, that are not done yet."""
+        done = self.Done(stage)
+        return [itemId for itemId in itemIds if str(itemId) not in done]
+
+    def Record(self, stage, items, status="done"):
+        """Record (item id, result) pairs as done or failed in one
+           transaction. Each record counts as an attempt at the item."""
+        now = time.time()
+        rows = [(self.runId, stage, str(itemId), status, None if result is None else json.dumps(result), now)
+                for itemId, result in items]
+        if len(rows) == 0:
+            return 0
+        with self.lock:
+            self.db.executemany("""INSERT INTO items VALUES (?, ?, ?, ?, 1, ?, ?)
+                                   ON CONFLICT (run_id, stage, item_id) DO UPDATE SET
+                                     status = excluded.status,
+                                     attempts = attempts + 1,
+                                     result = excluded.result,
+                                     updated = excluded.updated""", rows)
+            self.db.commit()
+        return len(rows)
+
+    def Stats(self, stage):
+        """Return the number of items of a stage by status."""
+        with self.lock:
+            rows = self.db.execute("""SELECT status, COUNT(*) FROM items
+                                      WHERE run_id = ? AND stage = ? GROUP BY status""",
+                                   (self.runId, stage)).fetchall()
+        return dict(rows)
+
+    def Close(self):
+        with self.lock:
+            self.db.close()
+
+
+# The process wide journal, created on first use
+sharedJournal = None
+sharedJournalLock = threading.Lock()
+
+
+def GetJournal(filepath="checkpoint_journal.sqlite", runId=None):
+    """Return the process wide journal. The file path and run id only
+       apply to the first call. Only a run id passed explicitly resumes
+       earlier work, the pipeline passes its run id so that --resume
+       picks up where an interrupted run stopped."""
+    global sharedJournal
+    with sharedJournalLock:
+        if sharedJournal is None:
+            sharedJournal = CheckpointJournal(filepath, runId)
+        return sharedJournal
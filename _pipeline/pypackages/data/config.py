@@ -73,11 +73,20 @@ teamConnQuote = f'''DRIVER={SQLDRIVERTEAM};
 
 MongoQuote = f'''mongodb://{MongoUser}:{MongoPass}==@{MongoLocation}/?ssl=true&retrywrites=false&replicaSet=globaldb&maxIdleTimeMS=120000&appName=@{MongoUser}@'''
 
+#---------------------------------------
+# Shared connection pool settings, SQL &
+# Mongo connections idle for longer than
+# the idle timeout in seconds are closed
+#---------------------------------------
+poolSize = 5
+poolIdleTimeout = 300
+
 #---------------------------------------
 # SQL misc. vaiables
 #---------------------------------------
 
 MongoDB = "shapes"
+MongoFlushSize = 500
 
 
 #---------------------------------------
@@ -107,6 +116,8 @@ SQLStr = """SELECT {0}
 
 SQLSelect = SQLStr = """SELECT * FROM {0}"""
 
+SQLSelectColumns = """SELECT {0}{1} FROM {2}"""
+
 SQLElevation = """SELECT
                     [dbo].[shapes].shape_id,[dbo].[shapes].shape_pt_lat,[dbo].[shapes].shape_pt_lon,[dbo].[shapes].shape_pt_sequence,
                     [dbo].[elevations].elevation
@@ -136,6 +147,33 @@ SQLConnectionFail = "Failed to connect to SQL database, please ensure that conne
 #---------------------------------------
 
 
+# Largest request body the Open-Elevation API accepts, in bytes
+elevRequestLimit = 10000
+
+# Concurrent elevation requests, at most elevWorkers in flight and
+# elevRatePerSecond started per second, each retried elevRetries times
+elevWorkers = 4
+elevRatePerSecond = 2
+elevRetries = 5
+
+# Local elevation cache, coordinates are matched
+# to elevCachePrecision decimal places
+elevCacheFile = "elevation_cache.sqlite"
+elevCachePrecision = 6
+
+# Checkpoint journal of collected items, elevations are looked up and
+# journaled elevCheckpointSize coordinates at a time so an interrupted
+# run only repeats the chunk it was on. Set journalRunId to the run id
+# an interrupted standalone run printed to resume it, None starts afresh
+journalFile = "checkpoint_journal.sqlite"
+journalRunId = None
+elevCheckpointSize = 5000
+
+# Elevation source, "open-elevation" for the API or "dem" for the
+# SRTM .hgt or GeoTIFF tiles in demTileDir
+elevationProvider = "open-elevation"
+demTileDir = os.environ.get("DEMTILEDIR", "dem_tiles")
+
 elevHeaders = {'Accept':'application/json',
                'Content-Type':'application/json'
                }
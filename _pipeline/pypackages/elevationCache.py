@@ -0,0 +1,76 @@
+import sqlite3
+import numpy as np
+
+
+class ElevationCache():
+    """Local persistent store of elevations keyed by coordinates
+       rounded to a fixed number of decimal places, 6 places is
+       roughly 0.1m."""
+    def __init__(self, filepath, precision=6):
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(filepath)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS elevations (
+                             coord_key INTEGER PRIMARY KEY,
+                             latitude REAL NOT NULL,
+                             longitude REAL NOT NULL,
+                             elevation REAL NOT NULL)""")
+        self.db.commit()
+
+    def __call__(self, *args):
+        if args[0] == "Keys":
+            return self.Keys(args[1], args[2])
+        elif args[0] == "Lookup":
+            return self.Lookup(args[1], args[2])
+        elif args[0] == "Store":
+            return self.Store(args[1], args[2], args[3])
+        elif args[0] == "Stats":
+            return self.Stats()
+        else:
+            return "Object does not exist."
+
+    def Keys(self, latitudes, longitudes):
+        """Return one integer key per coordinate, made from the
+           latitude and longitude quantized to the cache precision."""
+        scale = 10 ** self.precision
+        latKey = np.round(np.asarray(latitudes, dtype="float64") * scale).astype("int64") + 90 * scale
+        lonKey = np.round(np.asarray(longitudes, dtype="float64") * scale).astype("int64") + 180 * scale
+        return latKey * (360 * scale + 1) + lonKey
+
+    def Lookup(self, latitudes, longitudes):
+        """Return the cached elevation of each coordinate, NaN where
+           the coordinate is not in the cache."""
+        keys = self.Keys(latitudes, longitudes)
+        elevations = np.full(len(keys), np.nan)
+        if len(keys) == 0:
+            return elevations
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (coord_key INTEGER PRIMARY KEY)")
+        self.db.execute("DELETE FROM lookup")
+        self.db.executemany("INSERT OR IGNORE INTO lookup VALUES (?)", ((int(k),) for k in keys))
+        found = dict(self.db.execute("""SELECT e.coord_key, e.elevation FROM elevations e
+                                        JOIN lookup l ON e.coord_key = l.coord_key""").fetchall())
+        for position, key in enumerate(keys.tolist()):
+            if key in found:
+                elevations[position] = found[key]
+        hits = int(np.sum(~np.isnan(elevations)))
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return elevations
+
+    def Store(self, latitudes, longitudes, elevations):
+        """Save elevations for a set of coordinates."""
+        keys = self.Keys(latitudes, longitudes)
+        rows = zip(keys.tolist(),
+                   np.asarray(latitudes, dtype="float64").tolist(),
+                   np.asarray(longitudes, dtype="float64").tolist(),
+                   np.asarray(elevations, dtype="float64").tolist())
+        self.db.executemany("INSERT OR REPLACE INTO elevations VALUES (?, ?, ?, ?)", rows)
+        self.db.commit()
+
+    def Stats(self):
+        """Return the cache hit and miss counts."""
+        return {"hits": self.hits, "misses": self.misses}
+
+    def Close(self):
+        self.db.close()
@@ -0,0 +1,196 @@
+import os
+import re
+import struct
+import numpy as np
+import pandas as pd
+from _pipeline.pypackages.fetchEngine import FetchEngine
+
+
+class DemTile():
+    """A single elevation raster read through numpy.memmap, so only the
+       pages that are looked up are read from disk. Pixel (row, col)
+       is centred on (originLat - row * stepLat, originLon + col * stepLon)."""
+    def __init__(self, grid, originLat, originLon, stepLat, stepLon, nodata=None):
+        self.grid = grid
+        self.originLat = originLat
+        self.originLon = originLon
+        self.stepLat = stepLat
+        self.stepLon = stepLon
+        self.nodata = nodata
+        rows, cols = grid.shape
+        self.north = originLat
+        self.south = originLat - (rows - 1) * stepLat
+        self.west = originLon
+        self.east = originLon + (cols - 1) * stepLon
+
+    def Contains(self, lat, lon):
+        """Return a mask of the coordinates inside the tile."""
+        return (lat <= self.north) & (lat >= self.south) & \
+               (lon >= self.west) & (lon <= self.east)
+
+    def Bilinear(self, lat, lon):
+        """Interpolate elevations between the four surrounding pixels,
+           NaN where any of them has no data."""
+        rows, cols = self.grid.shape
+        row = (self.originLat - lat) / self.stepLat
+        col = (lon - self.originLon) / self.stepLon
+        row0 = np.clip(np.floor(row).astype("int64"), 0, rows - 2)
+        col0 = np.clip(np.floor(col).astype("int64"), 0, cols - 2)
+        dRow = row - row0
+        dCol = col - col0
+        corners = np.stack([self.grid[row0, col0], self.grid[row0, col0 + 1],
+                            self.grid[row0 + 1, col0], self.grid[row0 + 1, col0 + 1]]).astype("float64")
+        if self.nodata is not None:
+            corners[corners == self.nodata] = np.nan
+        top = corners[0] * (1 - dCol) + corners[1] * dCol
+        bottom = corners[2] * (1 - dCol) + corners[3] * dCol
+        return top * (1 - dRow) + bottom * dRow
+
+
+class DemElevationProvider():
+    """Look up elevations offline from SRTM .hgt or uncompressed
+       GeoTIFF tiles in a local folder."""
+    hgtName = re.compile(r"^([NS])(\d{2})([EW])(\d{3})\.hgt$", re.IGNORECASE)
+
+    def __init__(self, tileDir):
+        self.tiles = []
+        for name in sorted(os.listdir(tileDir)):
+            path = os.path.join(tileDir, name)
+            if self.hgtName.match(name):
+                self.tiles.append(self.ReadHgt(path))
+            elif name.lower().endswith((".tif", ".tiff")):
+                self.tiles.append(self.ReadGeoTiff(path))
+        if not self.tiles:
+            raise Exception(f"No .hgt or GeoTIFF tiles found in {tileDir}.")
+
+    def __call__(self, *args):
+        if args[0] == "Lookup":
+            return self.Lookup(args[1], args[2])
+        else:
+            return "Object does not exist."
+
+    def ReadHgt(self, path):
+        """Map an SRTM .hgt tile, big endian int16 with the corner
+           pixels on whole degrees.
+           **Not Callable outside of DemElevationProvider()**"""
+        ns, lat, ew, lon = self.hgtName.match(os.path.basename(path)).groups()
+        south = int(lat) * (1 if ns.upper() == "N" else -1)
+        west = int(lon) * (1 if ew.upper() == "E" else -1)
+        size = int(round(np.sqrt(os.path.getsize(path) / 2)))
+        grid = np.memmap(path, dtype=">i2", mode="r", shape=(size, size))
+        step = 1 / (size - 1)
+        return DemTile(grid, south + 1, west, step, step, nodata=-32768)
+
+    def ReadGeoTiff(self, path):
+        """Map a single band, uncompressed, north up GeoTIFF whose
+           strips are stored contiguously.
+           **Not Callable outside of DemElevationProvider()**"""
+        with open(path, "rb") as file:
+            order = {b"II": "<", b"MM": ">"}[file.read(2)]
+            magic, offset = struct.unpack(order + "HI", file.read(6))
+            if magic != 42:
+                raise Exception(f"{path} is not a classic TIFF file.")
+            file.seek(offset)
+            count = struct.unpack(order + "H", file.read(2))[0]
+            formats = {1: "B", 2: "s", 3: "H", 4: "I", 5: "II", 11: "f", 12: "d", 16: "Q"}
+            sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 11: 4, 12: 8, 16: 8}
+            tags = {}
+            for _ in range(count):
+                tag, kind, n, value = struct.unpack(order + "HHI4s", file.read(12))
+                size = sizes.get(kind, 1) * n
+                if size > 4:
+                    here = file.tell()
+                    file.seek(struct.unpack(order + "I", value)[0])
+                    raw = file.read(size)
+                    file.seek(here)
+                else:
+                    raw = value[:size]
+                if kind == 2:
+                    tags[tag] = raw.rstrip(b"\x00").decode("ascii", "ignore")
+                else:
+                    fmt = formats.get(kind, "B")
+                    tags[tag] = struct.unpack(order + fmt * n, raw)
+        width, height = tags[256][0], tags[257][0]
+        bits = tags[258][0]
+        sampleFormat = tags.get(339, (1,))[0]
+        if tags.get(259, (1,))[0] != 1 or tags.get(277, (1,))[0] != 1:
+            raise Exception(f"{path} must be an uncompressed single band GeoTIFF.")
+        if 273 not in tags:
+            raise Exception(f"{path} is tiled, only stripped GeoTIFFs are supported.")
+        offsets, counts = tags[273], tags[279]
+        for i in range(len(offsets) - 1):
+            if offsets[i] + counts[i] != offsets[i + 1]:
+                raise Exception(f"{path} strips are not contiguous.")
+        kinds = {1: "u", 2: "i", 3: "f"}
+        dtype = np.dtype(order + kinds[sampleFormat] + str(bits // 8))
+        grid = np.memmap(path, dtype=dtype, mode="r", offset=offsets[0], shape=(height, width))
+        scaleX, scaleY = tags[33550][0], tags[33550][1]
+        tieI, tieJ, _, tieX, tieY, _ = tags[33922][:6]
+        nodata = float(tags[42113]) if 42113 in tags else None
+        # Tie points refer to the pixel corner, pixel centres are half a pixel in
+        return DemTile(grid, tieY + (tieJ - 0.5) * scaleY, tieX + (0.5 - tieI) * scaleX,
+                       scaleY, scaleX, nodata)
+
+    def Lookup(self, latitudes, longitudes):
+        """Return the elevation of each coordinate, NaN where no tile
+           covers it."""
+        lat = np.asarray(latitudes, dtype="float64")
+        lon = np.asarray(longitudes, dtype="float64")
+        elevations = np.full(len(lat), np.nan)
+        remaining = np.ones(len(lat), dtype=bool)
+        for tile in self.tiles:
+            inside = remaining & tile.Contains(lat, lon)
+            if inside.any():
+                elevations[inside] = tile.Bilinear(lat[inside], lon[inside])
+                remaining &= ~inside
+        return elevations
+
+
+class OpenElevationProvider():
+    """Look up elevations from the Open-Elevation API, packing the
+       coordinates into as few requests as the API allows."""
+    def __init__(self, in_config, urlHandler):
+        self.in_config = in_config
+        self.url = urlHandler
+        self.fetcher = FetchEngine(in_config.url,
+                                   in_config.elevHeaders,
+                                   in_config.elevWorkers,
+                                   in_config.elevRatePerSecond,
+                                   in_config.elevRetries)
+
+    def __call__(self, *args):
+        if args[0] == "Lookup":
+            return self.Lookup(args[1], args[2])
+        else:
+            return "Object does not exist."
+
+    def Lookup(self, latitudes, longitudes):
+        """Return the elevation of each coordinate, NaN where its
+           request failed."""
+        locations = pd.DataFrame({"latitude": np.asarray(latitudes, dtype="float64"),
+                                  "longitude": np.asarray(longitudes, dtype="float64")})
+        elevations = np.full(len(locations), np.nan)
+        if len(locations) == 0:
+            return elevations
+        encoded = self.url("encodeLocations", locations)
+        batches, batchStats = self.url("packLocationBatches", encoded, self.in_config.elevRequestLimit)
+        print(f"{batchStats['batches']} batches to collect, "
+              f"{batchStats['fillRatio']:.1%} full on average.")
+        position = 0
+        for body, response in zip(batches, self.fetcher("FetchAll", batches)):
+            size = body.count(b'"latitude"')
+            if response is not None:
+                elevations[position:position + size] = [r["elevation"] for r in response["results"]]
+            position += size
+        return elevations
+
+
+def GetProvider(in_config, urlHandler=None):
+    """Return the elevation provider chosen in the config file,
+       'dem' for local tiles or 'open-elevation' for the API."""
+    if in_config.elevationProvider == "dem":
+        return DemElevationProvider(in_config.demTileDir)
+    elif in_config.elevationProvider == "open-elevation":
+        return OpenElevationProvider(in_config, urlHandler)
+    else:
+        raise Exception(f"Unknown elevation provider '{in_config.elevationProvider}'.")
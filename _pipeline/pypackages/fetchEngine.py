@@ -0,0 +1,266 @@
+import http.client
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def RetryDelay(attempt, retryAfter=None, baseDelay=1, maxDelay=60):
+    """Return the seconds to wait before retry number attempt, full
+       jitter exponential backoff unless the server said how long to
+       wait with a Retry-After header."""
+    if retryAfter is not None and str(retryAfter).isdigit():
+        return min(maxDelay, int(retryAfter))
+    return random.uniform(0, min(maxDelay, baseDelay * 2 ** attempt))
+
+
+class TokenBucket():
+    """Limit requests to a steady rate per second, allowing short
+       bursts of up to capacity requests."""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def Acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AIMDLimiter():
+    """Concurrency limit that grows by one after a full window of
+       successful requests and halves when the server pushes back."""
+    def __init__(self, initial=2, minimum=1, maximum=8):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.active = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def Acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def Release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def Increase(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    def Decrease(self):
+        with self.condition:
+            self.limit = max(self.minimum, self.limit // 2)
+            self.successes = 0
+
+
+class FetchEngine():
+    """POST many request bodies to a Json API concurrently, with a
+       rate limit, adaptive concurrency and retries with exponential
+       backoff and jitter."""
+    retryCodes = (429, 500, 502, 503, 504)
+
+    def __init__(self, url, headers, workers=8, rate=2, retries=5,
+                 baseDelay=1, maxDelay=60, timeout=120):
+        self.url = url
+        self.headers = headers
+        self.workers = workers
+        self.retries = retries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate)
+        self.limiter = AIMDLimiter(initial=min(2, workers), maximum=workers)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "failed": 0, "bytes": 0}
+
+    def __call__(self, *args):
+        if args[0] == "FetchAll":
+            return self.FetchAll(args[1])
+        elif args[0] == "Stats":
+            return self.Stats()
+        else:
+            return "Object does not exist."
+
+    def Count(self, name, value=1):
+        """Increment a stats counter.
+           **Not Callable outside of FetchEngine()**"""
+        with self.lock:
+            self.stats[name] += value
+
+    def Delay(self, attempt, retryAfter=None):
+        """Return the seconds to wait before a retry.
+           **Not Callable outside of FetchEngine()**"""
+        return RetryDelay(attempt, retryAfter, self.baseDelay, self.maxDelay)
+
+    def Backoff(self, attempt, retryAfter=None):
+        """Sleep before a retry.
+           **Not Callable outside of FetchEngine()**"""
+        time.sleep(self.Delay(attempt, retryAfter))
+
+    def Fetch(self, body):
+        """POST one request body and return the parsed Json response,
+           or None if every attempt failed.
+           **Not Callable outside of FetchEngine()**"""
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf8")
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.Count("retries")
+            retryAfter = None
+            self.limiter.Acquire()
+            try:
+                self.bucket.Acquire()
+                self.Count("requests")
+                req = urllib.request.Request(self.url, body, self.headers)
+                with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                    raw = response.read()
+                self.Count("bytes", len(raw))
+                data = json.loads(raw.decode("utf8"))
+                self.limiter.Increase()
+                return data
+            except urllib.error.HTTPError as e:
+                if e.code not in self.retryCodes:
+                    print(f"Request failed with HTTP {e.code}, not retrying.")
+                    break
+                self.Count("throttled")
+                self.limiter.Decrease()
+                retryAfter = e.headers.get("Retry-After") if e.headers else None
+            except (urllib.error.URLError, TimeoutError, ConnectionError,
+                    http.client.HTTPException, json.JSONDecodeError) as e:
+                # Dropped connections, cut off bodies (IncompleteRead) and
+                # malformed Json are retried like any other transient failure
+                self.limiter.Decrease()
+            finally:
+                self.limiter.Release()
+            if attempt < self.retries:
+                self.Backoff(attempt, retryAfter)
+        self.Count("failed")
+        return None
+
+    def FetchAll(self, bodies):
+        """Send every request body and return the responses in the
+           same order, None for any that failed."""
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(self.Fetch, bodies))
+        # Stats add up over every call, the engine is reused across chunks
+        failed = sum(result is None for result in results)
+        print(f"Fetched {len(bodies) - failed} of {len(bodies)} requests. {self.Stats()}")
+        return results
+
+    def Stats(self):
+        """Return request, retry, throttle and failure counts, the bytes
+           received and the final concurrency limit, totalled over every
+           call to FetchAll."""
+        with self.lock:
+            stats = dict(self.stats)
+        stats["concurrency"] = self.limiter.limit
+        return stats
+
+
+if __name__ == '__main__':
+    # Run the engine against a local stand-in for the elevation API that
+    # throttles when too many requests arrive at once, fails at random and
+    # sometimes cuts a response short or sends back malformed Json.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        active = 0
+        peak = 0
+        lock = threading.Lock()
+
+        def do_POST(self):
+            with StandInHandler.lock:
+                StandInHandler.active += 1
+                StandInHandler.peak = max(StandInHandler.peak, StandInHandler.active)
+                busy = StandInHandler.active > 4
+            try:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                time.sleep(0.05)
+                if busy:
+                    self.send_response(429)
+                    self.send_header("Retry-After", "0")
+                    self.end_headers()
+                elif random.random() < 0.1:
+                    self.send_response(503)
+                    self.end_headers()
+                elif random.random() < 0.05:
+                    # Promise more than is sent, the client sees IncompleteRead
+                    self.send_response(200)
+                    self.send_header("Content-Length", "1000")
+                    self.end_headers()
+                    self.wfile.write(b'{"results": [')
+                elif random.random() < 0.05:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.end_headers()
+                    self.wfile.write(b'{"results": [')
+                else:
+                    results = [dict(location, elevation=10) for location in body["locations"]]
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.end_headers()
+                    self.wfile.write(json.dumps({"results": results}).encode("utf8"))
+            finally:
+                with StandInHandler.lock:
+                    StandInHandler.active -= 1
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/v1/lookup"
+    bodies = [{"locations": [{"latitude": 53 + i / 1000, "longitude": -6}]} for i in range(100)]
+    engine = FetchEngine(url, {"Content-Type": "application/json"}, workers=8,
+                         rate=50, baseDelay=0.05, maxDelay=1)
+    start = time.time()
+    results = engine.FetchAll(bodies)
+    secs = time.time() - start
+    server.shutdown()
+    stats = engine.Stats()
+    assert all(r is not None for r in results), "Some requests failed."
+    assert [r["results"][0]["latitude"] for r in results] == [b["locations"][0]["latitude"] for b in bodies]
+    assert stats["failed"] == 0
+    # Every attempt past the first of a request is a retry after a backoff
+    assert stats["requests"] == len(bodies) + stats["retries"]
+    assert stats["retries"] >= stats["throttled"] > 0, "The stand-in never throttled."
+    # The token bucket holds requests to its rate after the initial burst
+    assert stats["requests"] <= engine.bucket.capacity + engine.bucket.rate * secs + 1, "Rate limit exceeded."
+    # The concurrency limit never goes past the number of workers
+    assert StandInHandler.peak <= engine.workers
+    assert engine.limiter.minimum <= stats["concurrency"] <= engine.workers
+
+    # Backoff: the limit halves on push back down to its minimum, retry
+    # delays stay under the doubling cap and Retry-After is followed
+    limiter = AIMDLimiter(initial=8, minimum=1, maximum=8)
+    for expected in (4, 2, 1, 1):
+        limiter.Decrease()
+        assert limiter.limit == expected
+    for attempt in range(8):
+        assert 0 <= engine.Delay(attempt) <= min(engine.maxDelay, engine.baseDelay * 2 ** attempt)
+    assert engine.Delay(3, "0") == 0 and engine.Delay(0, "3600") == engine.maxDelay
+    print(f"Stand-in run took {secs:.1f}s, peak concurrency at the server {StandInHandler.peak}")
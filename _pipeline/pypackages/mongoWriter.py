@@ -0,0 +1,91 @@
+import time
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+
+class BulkMongoWriter():
+    """Buffer documents and write them to a collection with unordered
+       insert_many once the buffer reaches a size or age threshold.
+       An onFlush function can be given to hear which documents each
+       flush wrote, e.g. to checkpoint progress."""
+    # Cosmos DB returns 16500 when the request rate is too large, these
+    # writes are retried rather than reported as failures
+    retryCodes = (16500,)
+    duplicateKey = 11000
+
+    def __init__(self, collection, flushSize=500, flushSeconds=10, retries=3, onFlush=None):
+        self.collection = collection
+        self.onFlush = onFlush
+        self.flushSize = flushSize
+        self.flushSeconds = flushSeconds
+        self.retries = retries
+        self.buffer = []
+        self.ids = []
+        self.errors = []
+        self.lastFlush = time.time()
+
+    def __call__(self, *args):
+        if args[0] == "Add":
+            return self.Add(args[1])
+        elif args[0] == "Flush":
+            return self.Flush()
+        elif args[0] == "Close":
+            return self.Close()
+        else:
+            return "Object does not exist."
+
+    def Add(self, document):
+        """Add a document to the buffer and return its position in
+           input order. The document's _id is set here so that it is
+           known before the document is written."""
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        self.ids.append(document["_id"])
+        self.buffer.append((len(self.ids) - 1, document))
+        if len(self.buffer) >= self.flushSize or \
+                time.time() - self.lastFlush >= self.flushSeconds:
+            self.Flush()
+        return len(self.ids) - 1
+
+    def Flush(self):
+        """Write the buffered documents. Throttled writes are retried
+           with backoff, any other failed document has its id set to
+           None and the error recorded. onFlush is then called with the
+           (position, ObjectId or None) of every document in the flush."""
+        flushed = [position for position, _ in self.buffer]
+        pending = self.buffer
+        self.buffer = []
+        self.lastFlush = time.time()
+        attempt = 0
+        while pending:
+            try:
+                self.collection.insert_many([doc for _, doc in pending], ordered=False)
+                pending = []
+            except BulkWriteError as e:
+                retry = []
+                for error in e.details.get("writeErrors", []):
+                    position, document = pending[error["index"]]
+                    if error["code"] == self.duplicateKey:
+                        # Already written by an earlier attempt
+                        continue
+                    elif error["code"] in self.retryCodes and attempt < self.retries:
+                        retry.append((position, document))
+                    else:
+                        self.ids[position] = None
+                        self.errors.append({"position": position, "code": error["code"],
+                                            "message": error.get("errmsg")})
+                pending = retry
+                attempt += 1
+                if pending:
+                    time.sleep(2 ** attempt)
+        if self.onFlush is not None and flushed:
+            self.onFlush([(position, self.ids[position]) for position in flushed])
+        return len(self.errors)
+
+    def Close(self):
+        """Flush any remaining documents and return the ObjectIds in
+           input order, with None for documents that failed."""
+        self.Flush()
+        if self.errors:
+            print(f"{len(self.errors)} documents failed to write to {self.collection.name}.")
+        return list(self.ids)
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class PipelineDag():
+    """Run pipeline steps as a graph rather than a fixed sequence. Each
+       step names the steps it runs after and the tables, files and
+       argument values it reads and writes. These are fingerprinted with
+       content hashes and a step is skipped when its inputs and outputs
+       are unchanged since its last successful run. Steps whose parents
+       are done run in parallel. If a PipelineMetrics object is given each
+       step that runs is recorded as a metrics step, and if a StepProfiler
+       is given each step is profiled."""
+    def __init__(self, stateFile="pipeline_state.json", tableHash=None, maxWorkers=4, metrics=None, profiler=None):
+        self.stateFile = stateFile
+        self.tableHash = tableHash
+        self.maxWorkers = maxWorkers
+        self.metrics = metrics
+        self.profiler = profiler
+        self.steps = {}
+        self.lock = threading.Lock()
+        self.state = self.LoadState()
+
+    def __call__(self, *args):
+        if args[0] == "Add":
+            return self.Add(*args[1:])
+        elif args[0] == "Run":
+            return self.Run(*args[1:])
+        elif args[0] == "Select":
+            return self.Select(*args[1:])
+        else:
+            return "Object does not exist."
+
+    def Add(self, name, run, after=(), tables=(), files=(), values=None, outputTables=(), outputFiles=()):
+        """Add a step. run is a function taking no arguments, after lists
+           steps that must finish first and must already be added, which
+           keeps the graph acyclic and the steps in a runnable order."""
+        if name in self.steps:
+            raise Exception(f"Step '{name}' has already been added.")
+        for parent in after:
+            if parent not in self.steps:
+                raise Exception(f"Step '{name}' runs after unknown step '{parent}'.")
+        self.steps[name] = {"run": run,
+                            "after": list(after),
+                            "tables": list(tables),
+                            "files": list(files),
+                            "values": dict(values or {}),
+                            "outputTables": list(outputTables),
+                            "outputFiles": list(outputFiles)}
+
+    def LoadState(self):
+        """Read the fingerprints recorded by earlier runs.
+           **Not Callable outside of PipelineDag()**"""
+        if not os.path.exists(self.stateFile):
+            return {}
+        with open(self.stateFile) as stateFile:
+            return json.load(stateFile)
+
+    def SaveState(self):
+        """Write the recorded fingerprints, replacing the file in one step
+           so that a crash cannot leave it half written.
+           **Not Callable outside of PipelineDag()**"""
+        with self.lock:
+            temp = self.stateFile + ".tmp"
+            with open(temp, "w") as stateFile:
+                json.dump(self.state, stateFile, indent=2, sort_keys=True)
+            os.replace(temp, self.stateFile)
+
+    def FileHash(self, filepath):
+        """Return the SHA-256 of a file's contents, or None if it is missing.
+           **Not Callable outside of PipelineDag()**"""
+        if not os.path.exists(filepath):
+            return None
+        digest = hashlib.sha256()
+        with open(filepath, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def Fingerprint(self, tables=(), files=(), values=None):
+        """Return a dict of item -> content hash for tables, files and
+           argument values.
+           **Not Callable outside of PipelineDag()**"""
+        fingerprint = {}
+        for table in tables:
+            fingerprint["table:" + table] = self.tableHash(table) if self.tableHash else None
+        for filepath in files:
+            fingerprint["file:" + filepath] = self.FileHash(filepath)
+        for name, value in (values or {}).items():
+            fingerprint["value:" + name] = hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+        return fingerprint
+
+    def Changed(self, name, inputs, outputs):
+        """Return the items that differ from the last successful run of a
+           step, or ["never run"] if it has not run.
+           **Not Callable outside of PipelineDag()**"""
+        previous = self.state.get(name)
+        if previous is None:
+            return ["never run"]
+        changed = [item for item in sorted(set(inputs) | set(previous["inputs"]))
+                   if inputs.get(item) != previous["inputs"].get(item)]
+        changed += [item + " (output)" for item in sorted(set(outputs) | set(previous["outputs"]))
+                    if outputs.get(item) != previous["outputs"].get(item)]
+        return changed
+
+    def Descendants(self, name):
+        """Return a step and every step downstream of it.
+           **Not Callable outside of PipelineDag()**"""
+        found = {name}
+        for step, details in self.steps.items():
+            if any(parent in found for parent in details["after"]):
+                found.add(step)
+        return found
+
+    def Select(self, start=None, only=None):
+        """Return the steps a run will consider, every step by default,
+           the start step and everything downstream of it, or only the
+           listed steps."""
+        for name in ([start] if start else []) + list(only or []):
+            if name not in self.steps:
+                raise Exception(f"Unknown step '{name}', steps are {', '.join(self.steps)}.")
+        if only:
+            return set(only)
+        if start:
+            return self.Descendants(start)
+        return set(self.steps)
+
+    def Execute(self, name):
+        """Run one step and return its duration in seconds.
+           **Not Callable outside of PipelineDag()**"""
+        s = time.time()
+        with ExitStack() as stack:
+            if self.metrics is not None:
+                stack.enter_context(self.metrics.Step(name))
+            if self.profiler is not None:
+                stack.enter_context(self.profiler.Profile(name))
+            self.steps[name]["run"]()
+        return time.time() - s
+
+    def Run(self, start=None, only=None, force=False):
+        """Run the selected steps. Steps chosen with start or only always
+           run, other selected steps run only if their fingerprints have
+           changed and unselected steps are treated as done. A failed step
+           stops the steps downstream of it, the rest carry on and the
+           failure is raised at the end. Returns a dict of step -> outcome."""
+        selected = self.Select(start, only)
+        forced = force or start is not None or bool(only)
+        outcomes = {name: "not selected" for name in self.steps if name not in selected}
+        done = set(outcomes)
+        failed = {}
+        pending = [name for name in self.steps if name in selected]
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as pool:
+            while pending or running:
+                # Steps are kept in the order added, so a parent is always
+                # settled before its children are looked at
+                for name in list(pending):
+                    step = self.steps[name]
+                    blocked = [parent for parent in step["after"] if parent in failed]
+                    if len(blocked) != 0:
+                        pending.remove(name)
+                        failed[name] = None
+                        outcomes[name] = "blocked by " + ", ".join(blocked)
+                        print(f"Step '{name}' not run, {outcomes[name]}")
+                        continue
+                    if not all(parent in done for parent in step["after"]):
+                        continue
+                    pending.remove(name)
+                    inputs = self.Fingerprint(step["tables"], step["files"], step["values"])
+                    outputs = self.Fingerprint(step["outputTables"], step["outputFiles"])
+                    changed = self.Changed(name, inputs, outputs)
+                    if not forced and len(changed) == 0:
+                        done.add(name)
+                        outcomes[name] = "skipped"
+                        print(f"Step '{name}' inputs unchanged, skipping")
+                        continue
+                    print(f"Step '{name}' starting, changed: {', '.join(changed) if not forced else 'forced'}")
+                    running[pool.submit(self.Execute, name)] = (name, inputs)
+                if len(running) == 0:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, inputs = running.pop(future)
+                    try:
+                        secs = future.result()
+                    except Exception as e:
+                        failed[name] = e
+                        outcomes[name] = "failed"
+                        print(f"Step '{name}' failed: {e}")
+                        continue
+                    # Outputs are fingerprinted once the step is done, so a
+                    # later run can tell if they were changed or dropped. An
+                    # item a step both reads and rewrites, such as a file it
+                    # downloads, is recorded as the step left it
+                    step = self.steps[name]
+                    outputs = self.Fingerprint(step["outputTables"], step["outputFiles"])
+                    inputs = {item: outputs.get(item, value) for item, value in inputs.items()}
+                    self.state[name] = {"inputs": inputs,
+                                        "outputs": outputs,
+                                        "finished": time.strftime("%Y-%m-%d %H:%M:%S")}
+                    self.SaveState()
+                    done.add(name)
+                    outcomes[name] = "ran"
+                    print(f"Step '{name}' done in {round(secs, 1)}s")
+        errors = {name: e for name, e in failed.items() if e is not None}
+        if len(errors) != 0:
+            raise Exception("Pipeline steps failed: " + "; ".join(f"{name}: {e}" for name, e in errors.items()))
+        return outcomes
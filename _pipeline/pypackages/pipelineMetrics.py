@@ -0,0 +1,174 @@
+import json
+import sys
+import threading
+import time
+import uuid
+import functools
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, psutil is used there if installed
+    resource = None
+
+
+class PipelineMetrics():
+    """Collect timers and counters shared by every Python step of a run.
+       Each record carries the run id and is appended to a local JSONL
+       file, and can also be saved to a pipeline_metrics SQL table so
+       runs can be compared over time."""
+    def __init__(self, filepath="pipeline_metrics.jsonl", runId=None):
+        self.filepath = filepath
+        self.runId = runId or time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+        self.records = []
+
+    def __call__(self, *args):
+        if args[0] == "Count":
+            return self.Count(*args[1:])
+        elif args[0] == "Timer":
+            return self.Timer(args[1])
+        elif args[0] == "Timed":
+            return self.Timed(*args[1:])
+        elif args[0] == "Step":
+            return self.Step(args[1])
+        elif args[0] == "PeakRssMb":
+            return self.PeakRssMb()
+        elif args[0] == "Flush":
+            return self.Flush()
+        elif args[0] == "SaveToSQL":
+            return self.SaveToSQL(*args[1:])
+        else:
+            return "Object does not exist."
+
+    def Count(self, name, value=1):
+        """Add to a counter, e.g. rows_written, http_calls or cache_hits."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def Timer(self, name):
+        """Time the block inside a with statement. Timers of the same name
+           are totalled with their call count and longest call."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            secs = time.time() - start
+            with self.lock:
+                timer = self.timers.setdefault(name, {"calls": 0, "secs": 0.0, "max_secs": 0.0})
+                timer["calls"] += 1
+                timer["secs"] += secs
+                timer["max_secs"] = max(timer["max_secs"], secs)
+
+    def Timed(self, name=None):
+        """Decorator timing every call of a function, named after the
+           function unless a name is given."""
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.Timer(name or function.__name__):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    @contextmanager
+    def Step(self, name):
+        """Time a pipeline step and record it as soon as it ends, with the
+           counters added while it ran and the peak RSS of the process so
+           far. Steps running at the same time share counters, so each
+           one's counts include the other's."""
+        with self.lock:
+            before = dict(self.counters)
+        start = time.time()
+        status = "failed"
+        try:
+            yield
+            status = "done"
+        finally:
+            secs = time.time() - start
+            with self.lock:
+                counts = {k: v - before.get(k, 0) for k, v in self.counters.items() if v != before.get(k, 0)}
+            records = [self.Record("step", name, name, secs, status=status)]
+            records += [self.Record("counter", counter, name, value) for counter, value in sorted(counts.items())]
+            self.Write(records)
+
+    def PeakRssMb(self):
+        """Return the peak resident memory of the process in MB, or None
+           if it cannot be measured on this platform."""
+        if resource is not None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Linux reports kilobytes, macOS bytes
+            return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / (1024 * 1024), 1)
+
+    def Record(self, kind, name, step=None, value=None, calls=None, maxSecs=None, status=None):
+        """Build one metrics record.
+           **Not Callable outside of PipelineMetrics()**"""
+        return {"run_id": self.runId,
+                "recorded_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "kind": kind,
+                "name": name,
+                "step": step,
+                "value": None if value is None else round(float(value), 3),
+                "calls": calls,
+                "max_secs": None if maxSecs is None else round(maxSecs, 3),
+                "status": status,
+                "peak_rss_mb": self.PeakRssMb()}
+
+    def Write(self, records):
+        """Append records to the JSONL file as they are made, so a crashed
+           run still leaves the metrics of the steps that finished.
+           **Not Callable outside of PipelineMetrics()**"""
+        with self.lock:
+            self.records.extend(records)
+            if self.filepath is None:
+                return
+            with open(self.filepath, "a") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+
+    def Flush(self):
+        """Record the run totals of every timer and counter. Call once at
+           the end of a run."""
+        with self.lock:
+            timers = {name: dict(timer) for name, timer in self.timers.items()}
+            counters = dict(self.counters)
+        records = [self.Record("timer", name, value=timer["secs"], calls=timer["calls"], maxSecs=timer["max_secs"])
+                   for name, timer in sorted(timers.items())]
+        records += [self.Record("counter", name, value=value) for name, value in sorted(counters.items())]
+        self.Write(records)
+        return records
+
+    def SaveToSQL(self, eng, table="pipeline_metrics"):
+        """Append every record of this run to a SQL table."""
+        with self.lock:
+            records = list(self.records)
+        if len(records) == 0:
+            return None
+        pd.DataFrame.from_records(records).to_sql(table, eng, index=False, if_exists="append")
+        print(f"Saved {len(records)} metrics for run {self.runId} to {table}")
+
+
+# The process wide metrics, created on first use
+sharedMetrics = None
+sharedMetricsLock = threading.Lock()
+
+
+def GetMetrics(filepath="pipeline_metrics.jsonl", runId=None):
+    """Return the process wide metrics. The file path and run id only
+       apply to the first call."""
+    global sharedMetrics
+    with sharedMetricsLock:
+        if sharedMetrics is None:
+            sharedMetrics = PipelineMetrics(filepath, runId)
+        return sharedMetrics
@@ -0,0 +1,150 @@
+import threading
+import time
+import urllib
+import pymongo
+from pymongo import monitoring
+from sqlalchemy import create_engine, event, exc
+
+
+class MongoCounter(monitoring.ConnectionPoolListener):
+    """Count Mongo connections opened and checked out.
+       **Not Callable outside of ResourcePool()**"""
+    def __init__(self, counters, lock):
+        self.counters = counters
+        self.lock = lock
+
+    def Add(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def connection_created(self, event):
+        self.Add("mongo_opened")
+
+    def connection_checked_out(self, event):
+        self.Add("mongo_checkouts")
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_check_out_failed(self, event): pass
+    def connection_checked_in(self, event): pass
+
+
+class ResourcePool():
+    """Share SQL engines and Mongo clients across pipeline steps so that
+       connections are reused rather than opened on every call. For both,
+       a connection left idle for longer than idleTimeout seconds is
+       closed rather than reused, connections in use are never recycled."""
+    def __init__(self, poolSize=5, idleTimeout=300):
+        self.poolSize = poolSize
+        self.idleTimeout = idleTimeout
+        self.engines = {}
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.counters = {"sql_opened": 0, "sql_checkouts": 0,
+                         "mongo_opened": 0, "mongo_checkouts": 0}
+
+    def __call__(self, *args):
+        if args[0] == "SQLEngine":
+            return self.SQLEngine(args[1])
+        elif args[0] == "MongoClient":
+            return self.MongoClient(args[1])
+        elif args[0] == "Counters":
+            return self.Counters()
+        elif args[0] == "CloseAll":
+            return self.CloseAll()
+        else:
+            return "Object does not exist."
+
+    def Add(self, name):
+        """Increment a counter.
+           **Not Callable outside of ResourcePool()**"""
+        with self.lock:
+            self.counters[name] += 1
+
+    def MarkIdle(self, dbapiConn, record):
+        """Note when a SQL connection went back to the pool.
+           **Not Callable outside of ResourcePool()**"""
+        record.info["idle_since"] = time.monotonic()
+
+    def CheckIdle(self, dbapiConn, record, proxy):
+        """Refuse a SQL connection that sat in the pool for longer than
+           the idle timeout, the pool closes it and opens a new one.
+           **Not Callable outside of ResourcePool()**"""
+        idleSince = record.info.pop("idle_since", None)
+        if idleSince is not None and time.monotonic() - idleSince > self.idleTimeout:
+            raise exc.DisconnectionError("Connection idle for longer than the idle timeout")
+
+    def SQLEngine(self, connStr):
+        """Return the shared SQLAlchemy engine for a connection string.
+           Requires: ODBC connection string or SQLAlchemy URL."""
+        with self.lock:
+            if connStr in self.engines:
+                return self.engines[connStr]
+            if "://" in connStr:
+                eng = create_engine(connStr)
+            else:
+                url = 'mssql+pyodbc:///?odbc_connect={}'.format(urllib.parse.quote_plus(connStr))
+                # Pre ping replaces a connection the server dropped before
+                # use rather than failing on it
+                eng = create_engine(url, fast_executemany=True,
+                                    pool_size=self.poolSize,
+                                    max_overflow=self.poolSize,
+                                    pool_pre_ping=True)
+            # SQLAlchemy has no idle timeout of its own, pool_recycle is a
+            # maximum age that would also recycle busy connections
+            event.listen(eng, "checkin", self.MarkIdle)
+            event.listen(eng, "checkout", self.CheckIdle)
+            event.listen(eng, "connect", lambda *args: self.Add("sql_opened"))
+            event.listen(eng, "checkout", lambda *args: self.Add("sql_checkouts"))
+            self.engines[connStr] = eng
+            return eng
+
+    def MongoClient(self, uri):
+        """Return the shared MongoClient for a connection uri.
+           Requires: Mongo connection uri."""
+        with self.lock:
+            if uri not in self.clients:
+                self.clients[uri] = pymongo.MongoClient(
+                    uri,
+                    maxPoolSize=self.poolSize,
+                    maxIdleTimeMS=self.idleTimeout * 1000,
+                    event_listeners=[MongoCounter(self.counters, self.lock)])
+            return self.clients[uri]
+
+    def Counters(self):
+        """Return connections opened and reused for SQL and Mongo."""
+        with self.lock:
+            counters = dict(self.counters)
+        counters["sql_reused"] = counters["sql_checkouts"] - counters["sql_opened"]
+        counters["mongo_reused"] = max(counters["mongo_checkouts"] - counters["mongo_opened"], 0)
+        return counters
+
+    def CloseAll(self):
+        """Dispose of every engine and close every client."""
+        with self.lock:
+            for eng in self.engines.values():
+                eng.dispose()
+            for client in self.clients.values():
+                client.close()
+            self.engines = {}
+            self.clients = {}
+
+
+# The process wide pool, created on first use
+sharedPool = None
+sharedPoolLock = threading.Lock()
+
+
+def GetPool(poolSize=5, idleTimeout=300):
+    """Return the process wide resource pool. The pool size and idle
+       timeout only apply to the first call."""
+    global sharedPool
+    with sharedPoolLock:
+        if sharedPool is None:
+            sharedPool = ResourcePool(poolSize, idleTimeout)
+        return sharedPool
@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+
+
+class RouteCodec():
+    """Store dead trip and dead leg shapes, or any other paths, as one
+       row per route. The points of a route are packed into a geometry blob of big endian
+       int32 pairs in microdegrees, the first pair holding the first
+       point and every later pair the change from the point before.
+       SQL Server reads binary as big endian integers, so a view can
+       expand the blob back into one row per point."""
+    scale = 1000000
+
+    def __init__(self, idColumn="dead_trip_unique_id", summaryColumns=("distance_km", "time_hrs")):
+        self.idColumn = idColumn
+        self.summaryColumns = list(summaryColumns)
+
+    def __call__(self, *args):
+        if args[0] == "Encode":
+            return self.Encode(args[1])
+        elif args[0] == "Decode":
+            return self.Decode(args[1])
+        elif args[0] == "EncodeChunks":
+            return self.EncodeChunks(args[1])
+        elif args[0] == "ViewSQL":
+            return self.ViewSQL(args[1], args[2])
+        else:
+            return "Object does not exist."
+
+    def Starts(self, ids):
+        """Return a mask of the first point of each route, the points of
+           a route must be next to each other.
+           **Not Callable outside of RouteCodec()**"""
+        starts = np.ones(len(ids), dtype=bool)
+        starts[1:] = ids[1:] != ids[:-1]
+        return starts
+
+    def Encode(self, points):
+        """Pack a dataframe of route points, in point order and with the
+           points of each route together, into one row per route."""
+        if len(points.index) == 0:
+            return pd.DataFrame(columns=[self.idColumn] + self.summaryColumns + ["n_points", "geometry"])
+        ids = points[self.idColumn].to_numpy()
+        starts = self.Starts(ids)
+        coords = np.round(points[["latitude", "longitude"]].to_numpy(dtype="float64") * self.scale).astype("int64")
+        deltas = coords.copy()
+        deltas[1:] -= coords[:-1]
+        deltas[starts] = coords[starts]
+        # Deltas only overflow int32 for jumps longer than 2000 degrees
+        packed = deltas.astype(">i4")
+        first = np.flatnonzero(starts)
+        counts = np.diff(np.append(first, len(ids)))
+        buffer = packed.tobytes()
+        offsets = np.append(first, len(ids)) * 8
+        routes = points.iloc[first][[self.idColumn] + self.summaryColumns].reset_index(drop=True)
+        routes["n_points"] = counts.astype("int32")
+        routes["geometry"] = [buffer[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        return routes
+
+    def Decode(self, routes):
+        """Expand one row per route back into one row per point with the
+           same columns tabulateRouteInfo gives."""
+        counts = routes["n_points"].to_numpy(dtype="int64")
+        if len(routes.index) == 0 or counts.sum() == 0:
+            return pd.DataFrame(columns=[self.idColumn, "latitude", "longitude", "point_order"] + self.summaryColumns)
+        deltas = np.frombuffer(b"".join(routes["geometry"]), dtype=">i4").reshape(-1, 2).astype("int64")
+        total = np.cumsum(deltas, axis=0)
+        first = np.cumsum(counts) - counts
+        # Remove the running total of earlier routes from each route
+        before = np.zeros((len(counts), 2), dtype="int64")
+        before[1:] = total[first[1:] - 1]
+        coords = total - np.repeat(before, counts, axis=0)
+        points = pd.DataFrame({self.idColumn: np.repeat(routes[self.idColumn].to_numpy(), counts),
+                               "latitude": coords[:, 0] / self.scale,
+                               "longitude": coords[:, 1] / self.scale,
+                               "point_order": (np.arange(counts.sum()) - np.repeat(first, counts) + 1).astype("int32")})
+        for column in self.summaryColumns:
+            points[column] = np.repeat(routes[column].to_numpy(), counts)
+        return points
+
+    def EncodeChunks(self, chunks):
+        """Encode a stream of point chunks, as made by iterRouteInfo, into
+           a stream of route chunks. A route split across two point chunks
+           is held back and encoded whole with the next chunk."""
+        held = None
+        for chunk in chunks:
+            if held is not None:
+                chunk = pd.concat([held, chunk], ignore_index=True)
+            if len(chunk.index) == 0:
+                held = None
+                continue
+            ids = chunk[self.idColumn].to_numpy()
+            last = np.flatnonzero(self.Starts(ids))[-1]
+            held = chunk.iloc[last:]
+            if last > 0:
+                yield self.Encode(chunk.iloc[:last])
+        if held is not None and len(held.index) != 0:
+            yield self.Encode(held)
+
+    def ViewSQL(self, view, table):
+        """Return the SQL Server statement creating a view that expands a
+           route table into the columns and rows of the old shapes table."""
+        point = "CAST(CAST(SUBSTRING(r.geometry, 8 * t.n + {0}, 4) AS INT) AS BIGINT)"
+        running = "CAST(SUM(" + point + ") OVER (PARTITION BY r.[{1}] ORDER BY t.n ROWS UNBOUNDED PRECEDING) AS FLOAT) / {2}"
+        return """CREATE OR ALTER VIEW [{0}] AS
+WITH tally AS (
+    SELECT TOP (SELECT ISNULL(MAX(n_points), 0) FROM [{1}])
+           ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS n
+    FROM sys.all_columns a CROSS JOIN sys.all_columns b
+)
+SELECT r.[{2}],
+       {3} AS latitude,
+       {4} AS longitude,
+       CAST(t.n + 1 AS INT) AS point_order{5}
+FROM [{1}] r
+JOIN tally t ON t.n < r.n_points""".format(view, table, self.idColumn,
+                                        running.format(1, self.idColumn, self.scale),
+                                        running.format(5, self.idColumn, self.scale),
+                                        "".join(",\n       r.[{0}]".format(c) for c in self.summaryColumns))
+
+
+if __name__ == '__main__':
+    # Compare the size of the point rows and the encoded routes for
+    # routes of a few hundred points, in memory and stored as tables with
+    # their indexes in SQLite, and check the round trip.
+    import os
+    import sys
+    import time
+    import sqlite3
+    import tempfile
+    nRoutes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    counts = np.random.randint(50, 800, nRoutes)
+    ids = np.repeat(np.arange(1, nRoutes + 1), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    points = pd.DataFrame({"dead_trip_unique_id": ids,
+                           "latitude": np.round(53.35 + np.cumsum(np.random.normal(0, 0.0002, len(ids))), 5),
+                           "longitude": np.round(-6.26 + np.cumsum(np.random.normal(0, 0.0002, len(ids))), 5),
+                           "point_order": (np.arange(len(ids)) - starts + 1).astype("int32"),
+                           "distance_km": np.repeat(np.random.uniform(1, 20, nRoutes), counts),
+                           "time_hrs": np.repeat(np.random.uniform(0.05, 1, nRoutes), counts)})
+    codec = RouteCodec()
+    start = time.time()
+    routes = codec.Encode(points)
+    encodeSecs = time.time() - start
+    start = time.time()
+    decoded = codec.Decode(routes)
+    decodeSecs = time.time() - start
+    assert np.allclose(decoded[["latitude", "longitude"]], points[["latitude", "longitude"]], atol=5e-7)
+    assert (decoded["point_order"] == points["point_order"]).all()
+    pointBytes = points.memory_usage(index=False).sum()
+    routeBytes = routes.drop(columns="geometry").memory_usage(index=False).sum() + routes["geometry"].str.len().sum()
+    print(f"{len(points)} points in {len(routes)} routes: {pointBytes / routeBytes:.1f}x smaller in memory, "
+          f"encode {len(points) / encodeSecs:,.0f} points/s, decode {len(points) / decodeSecs:,.0f} points/s")
+    # Stored size, each table with the index the pipeline builds on it:
+    # the old point table on the trip id, the route table covering the
+    # per route columns. This includes the per row overhead of the table.
+    stored = {}
+    with tempfile.TemporaryDirectory() as tempDir:
+        for name, df, index in (("points", points, "dead_trip_unique_id"),
+                                ("routes", routes, "dead_trip_unique_id, distance_km, time_hrs, n_points")):
+            filepath = os.path.join(tempDir, name + ".sqlite")
+            db = sqlite3.connect(filepath)
+            df.to_sql(name, db, index=False)
+            db.execute(f"CREATE INDEX idx_{name} ON {name} ({index})")
+            db.commit()
+            db.execute("VACUUM")
+            db.close()
+            stored[name] = os.path.getsize(filepath)
+    print(f"Stored in SQLite: {stored['points'] / 1e6:.1f} MB of point rows, {stored['routes'] / 1e6:.1f} MB of routes, "
+          f"{stored['points'] / stored['routes']:.1f}x smaller")
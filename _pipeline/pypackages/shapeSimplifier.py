@@ -0,0 +1,222 @@
+import numpy as np
+import pandas as pd
+
+
+class ShapeSimplifier():
+    """Reduce GTFS shapes to the points needed to keep each path within
+       a tolerance in metres. Points closer than spacing metres along the
+       path are thinned first, then Douglas-Peucker is run per shape and
+       any dropped point still further than the tolerance from the result
+       is put back, so no dropped point strays more than tolerance metres.
+       Dropped points are kept in the output, flagged by the keep
+       column, so their elevations can be interpolated afterwards."""
+    earthRadius = 6371008.8
+
+    def __init__(self, tolerance=5.0, spacing=10.0, groupColumn="shape_id",
+                 latColumn="shape_pt_lat", lonColumn="shape_pt_lon",
+                 sequenceColumn="shape_pt_sequence"):
+        self.tolerance = tolerance
+        self.spacing = spacing
+        self.groupColumn = groupColumn
+        self.latColumn = latColumn
+        self.lonColumn = lonColumn
+        self.sequenceColumn = sequenceColumn
+        self.stats = {}
+
+    def __call__(self, *args):
+        if args[0] == "Simplify":
+            return self.Simplify(args[1])
+        elif args[0] == "Interpolate":
+            return self.Interpolate(args[1], args[2])
+        elif args[0] == "Stats":
+            return self.Stats()
+        else:
+            return "Object does not exist."
+
+    def Project(self, lat, lon, groups):
+        """Project coordinates to metres on a plane tangent at the
+           mean latitude of each shape.
+           **Not Callable outside of ShapeSimplifier()**"""
+        meanLat = pd.Series(lat).groupby(groups).transform("mean").to_numpy()
+        x = np.radians(lon) * np.cos(np.radians(meanLat)) * self.earthRadius
+        y = np.radians(lat) * self.earthRadius
+        return x, y
+
+    def Starts(self, groups):
+        """Return a mask of the first point of each shape, the rows
+           must already be sorted by shape.
+           **Not Callable outside of ShapeSimplifier()**"""
+        starts = np.ones(len(groups), dtype=bool)
+        starts[1:] = groups[1:] != groups[:-1]
+        return starts
+
+    def Distances(self, x, y, starts):
+        """Return the distance of each point along its shape in metres.
+           **Not Callable outside of ShapeSimplifier()**"""
+        step = np.zeros(len(x))
+        step[1:] = np.hypot(np.diff(x), np.diff(y))
+        step[starts] = 0
+        total = np.cumsum(step)
+        return total - np.maximum.accumulate(np.where(starts, total, 0))
+
+    def Thin(self, distance, starts):
+        """Keep the first point in each spacing metre stretch of a shape
+           and the last point of every shape, or every point if spacing
+           is 0.
+           **Not Callable outside of ShapeSimplifier()**"""
+        if self.spacing <= 0:
+            return np.ones(len(distance), dtype=bool)
+        keep = starts.copy()
+        bins = np.floor(distance / self.spacing)
+        keep[1:] |= bins[1:] != bins[:-1]
+        keep[:-1] |= starts[1:]
+        keep[-1:] = True
+        return keep
+
+    def SegmentDistance(self, px, py, ax, ay, bx, by):
+        """Distance from each point to the segment between a and b.
+           **Not Callable outside of ShapeSimplifier()**"""
+        dx = bx - ax
+        dy = by - ay
+        length = dx * dx + dy * dy
+        t = ((px - ax) * dx + (py - ay) * dy) / np.where(length > 0, length, 1)
+        t = np.clip(t, 0, 1)
+        return np.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+    def DouglasPeucker(self, x, y):
+        """Return a mask of the points Douglas-Peucker keeps for one
+           path, using a stack rather than recursion so long shapes
+           cannot exceed the recursion limit.
+           **Not Callable outside of ShapeSimplifier()**"""
+        keep = np.zeros(len(x), dtype=bool)
+        keep[0] = keep[-1] = True
+        stack = [(0, len(x) - 1)]
+        while stack:
+            first, last = stack.pop()
+            if last - first < 2:
+                continue
+            offsets = self.SegmentDistance(x[first + 1:last], y[first + 1:last],
+                                           x[first], y[first], x[last], y[last])
+            furthest = int(np.argmax(offsets))
+            if offsets[furthest] > self.tolerance:
+                middle = first + 1 + furthest
+                keep[middle] = True
+                stack.append((first, middle))
+                stack.append((middle, last))
+        return keep
+
+    def Deviation(self, x, y, keep):
+        """Distance from each dropped point to the simplified path
+           between the kept points either side of it.
+           **Not Callable outside of ShapeSimplifier()**"""
+        positions = np.arange(len(x))
+        previous = np.maximum.accumulate(np.where(keep, positions, 0))
+        following = np.minimum.accumulate(np.where(keep, positions, len(x) - 1)[::-1])[::-1]
+        dropped = ~keep
+        return self.SegmentDistance(x[dropped], y[dropped],
+                                    x[previous[dropped]], y[previous[dropped]],
+                                    x[following[dropped]], y[following[dropped]])
+
+    def Refine(self, x, y, keep):
+        """Douglas-Peucker only sees the thinned points, so a point
+           thinned away can lie past the tolerance. Keep the furthest
+           such point between each pair of kept points and check again
+           until every dropped point is within the tolerance.
+           **Not Callable outside of ShapeSimplifier()**"""
+        positions = np.arange(len(x))
+        while True:
+            deviation = self.Deviation(x, y, keep)
+            over = deviation > self.tolerance
+            if not over.any():
+                return keep
+            rows = np.flatnonzero(~keep)[over]
+            previous = np.maximum.accumulate(np.where(keep, positions, 0))[rows]
+            order = np.lexsort((-deviation[over], previous))
+            furthest = np.ones(len(order), dtype=bool)
+            furthest[1:] = previous[order][1:] != previous[order][:-1]
+            keep[rows[order][furthest]] = True
+
+    def Simplify(self, shapes):
+        """Sort the shapes, add each point's distance along its shape and
+           flag the points to keep. Returns a new dataframe with every
+           input point and the columns distance_m and keep."""
+        df = shapes.sort_values([self.groupColumn, self.sequenceColumn]).reset_index(drop=True)
+        if len(df.index) == 0:
+            return df.assign(distance_m=pd.Series(dtype="float64"), keep=pd.Series(dtype=bool))
+        groups = df[self.groupColumn].to_numpy()
+        lat = df[self.latColumn].to_numpy(dtype="float64")
+        lon = df[self.lonColumn].to_numpy(dtype="float64")
+        x, y = self.Project(lat, lon, groups)
+        starts = self.Starts(groups)
+        distance = self.Distances(x, y, starts)
+        thinned = np.flatnonzero(self.Thin(distance, starts))
+        keep = np.zeros(len(df.index), dtype=bool)
+        bounds = np.append(np.flatnonzero(starts[thinned]), len(thinned))
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            rows = thinned[first:last]
+            keep[rows[self.DouglasPeucker(x[rows], y[rows])]] = True
+        keep = self.Refine(x, y, keep)
+        deviation = self.Deviation(x, y, keep)
+        self.stats = {"shapes": int(starts.sum()),
+                      "points": len(df.index),
+                      "kept": int(keep.sum()),
+                      "reduction": round(len(df.index) / max(1, int(keep.sum())), 1),
+                      "maxDeviationMetres": round(float(deviation.max()), 2) if len(deviation) else 0.0,
+                      "meanDeviationMetres": round(float(deviation.mean()), 2) if len(deviation) else 0.0}
+        df["distance_m"] = distance
+        df["keep"] = keep
+        return df
+
+    def Interpolate(self, simplified, column):
+        """Fill a column that is only set on the kept points, for example
+           elevation, by linear interpolation along the distance of each
+           shape. Returns the filled values as an array."""
+        values = simplified[column].to_numpy(dtype="float64")
+        keep = simplified["keep"].to_numpy()
+        groups = simplified[self.groupColumn].to_numpy()
+        distance = simplified["distance_m"].to_numpy()
+        # Shift each shape past the end of the one before so a single
+        # interpolation over all shapes never crosses between them
+        starts = self.Starts(groups)
+        lengths = np.where(starts, np.roll(distance, 1), 0)
+        lengths[0] = 0
+        offset = np.cumsum(lengths + np.where(starts, 1.0, 0))
+        position = distance + offset
+        known = keep & ~np.isnan(values)
+        if not known.any():
+            return values
+        return np.interp(position, position[known], values[known])
+
+    def Stats(self):
+        """Return the point counts and the horizontal error of the last
+           simplification."""
+        return dict(self.stats)
+
+
+if __name__ == '__main__':
+    # Simplify synthetic shapes sampled every 3m and report the
+    # reduction and the error against the full resolution path.
+    import sys
+    import time
+    nShapes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rows = []
+    for shape in range(nShapes):
+        steps = np.arange(0, 15000, 3.0)
+        heading = np.cumsum(np.random.normal(0, 0.01, len(steps)))
+        north = np.cumsum(np.cos(heading) * 3)
+        east = np.cumsum(np.sin(heading) * 3)
+        rows.append(pd.DataFrame({"shape_id": f"shape_{shape}",
+                                  "shape_pt_lat": 53.35 + north / 111195,
+                                  "shape_pt_lon": -6.26 + east / (111195 * np.cos(np.radians(53.35))),
+                                  "shape_pt_sequence": np.arange(1, len(steps) + 1),
+                                  "elevation": 50 + 20 * np.sin(steps / 2000)}))
+    shapes = pd.concat(rows, ignore_index=True)
+    simplifier = ShapeSimplifier()
+    start = time.time()
+    simplified = simplifier.Simplify(shapes)
+    print(f"Simplified {len(shapes)} points in {time.time() - start:.2f}s: {simplifier.Stats()}")
+    known = simplified["elevation"].where(simplified["keep"])
+    filled = simplifier.Interpolate(simplified.assign(elevation=known), "elevation")
+    error = np.abs(filled - simplified["elevation"].to_numpy())
+    print(f"Interpolated elevation error: max {error.max():.2f}m, mean {error.mean():.3f}m")
+    assert simplifier.Stats()["maxDeviationMetres"] <= simplifier.tolerance, "Tolerance exceeded."
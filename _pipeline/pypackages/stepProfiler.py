@@ -0,0 +1,167 @@
+import os
+import sys
+import time
+import cProfile
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+class StackSampler():
+    """Sample the stacks of every thread at a fixed interval from a
+       background thread. Unlike cProfile, which only sees the thread it
+       was started on, this also catches work done in worker threads.
+       **Not Callable outside of StepProfiler()**"""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def Label(self, code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def Sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.Label(frame.f_code))
+                frame = frame.f_back
+            key = ";".join([names.get(ident, str(ident))] + stack[::-1])
+            self.counts[key] = self.counts.get(key, 0) + 1
+        self.samples += 1
+
+    def Run(self):
+        while not self.stopped.wait(self.interval):
+            self.Sample()
+
+    def Start(self):
+        self.thread = threading.Thread(target=self.Run, name="stack-sampler", daemon=True)
+        self.thread.start()
+
+    def Stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class StepProfiler():
+    """Profile pipeline steps, writing for each step a cProfile pstats
+       file, wall clock stacks of every thread in the collapsed format
+       read by flamegraph tools, and the top allocation sites from a
+       tracemalloc snapshot. Files go to outDir/runId/<step>.*"""
+    def __init__(self, outDir="profiles", runId=None, topN=25, interval=0.01, allocations=True):
+        self.runDir = os.path.join(outDir, runId or time.strftime("%Y%m%d-%H%M%S"))
+        self.topN = topN
+        self.interval = interval
+        self.allocations = allocations
+        os.makedirs(self.runDir, exist_ok=True)
+
+    def __call__(self, *args):
+        if args[0] == "Profile":
+            return self.Profile(args[1])
+        elif args[0] == "Diff":
+            return Diff(*args[1:])
+        else:
+            return "Object does not exist."
+
+    @contextmanager
+    def Profile(self, name):
+        """Profile the block inside a with statement as step name. Steps
+           should run one at a time while profiling, as tracemalloc and
+           the stack sampler see the whole process."""
+        profiler = cProfile.Profile()
+        sampler = StackSampler(self.interval)
+        if self.allocations:
+            tracemalloc.start()
+        sampler.Start()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            sampler.Stop()
+            snapshot = None
+            if self.allocations:
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            path = os.path.join(self.runDir, name)
+            profiler.dump_stats(path + ".pstats")
+            self.WriteCollapsed(path + ".collapsed", sampler)
+            if snapshot is not None:
+                self.WriteAllocations(path + ".alloc.txt", snapshot, peak)
+            print(f"Profile of step '{name}' written to {path}.*")
+
+    def WriteCollapsed(self, filepath, sampler):
+        """Write one line per distinct stack, frames separated by ';' and
+           followed by the number of samples it was seen in.
+           **Not Callable outside of StepProfiler()**"""
+        with open(filepath, "w") as f:
+            for stack, count in sorted(sampler.counts.items()):
+                f.write(f"{stack} {count}\n")
+
+    def WriteAllocations(self, filepath, snapshot, peak):
+        """Write the source lines holding the most memory at the end of
+           the step, and the peak memory traced while it ran.
+           **Not Callable outside of StepProfiler()**"""
+        # Leave out the memory used by the profiler itself
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                           tracemalloc.Filter(False, __file__),
+                                           tracemalloc.Filter(False, "<frozen importlib._bootstrap>")])
+        top = snapshot.statistics("lineno")
+        with open(filepath, "w") as f:
+            f.write(f"Peak traced memory: {peak / 1024 / 1024:.1f} MB\n")
+            f.write(f"Held at end of step: {sum(s.size for s in top) / 1024 / 1024:.1f} MB\n\n")
+            for stat in top[:self.topN]:
+                frame = stat.traceback[0]
+                f.write(f"{stat.size / 1024:10.1f} KB {stat.count:8d} blocks  {frame.filename}:{frame.lineno}\n")
+
+
+def FunctionTimes(filepath):
+    """Return a dict of function -> (calls, own seconds, cumulative
+       seconds) from a pstats file."""
+    stats = pstats.Stats(filepath).stats
+    return {f"{func} ({os.path.basename(file)}:{line})": (calls, tottime, cumtime)
+            for (file, line, func), (_, calls, tottime, cumtime, _) in stats.items()}
+
+
+def Diff(runDirA, runDirB, topN=20):
+    """Compare the profiles of two runs step by step and return a report
+       of each step's total time and the functions whose cumulative time
+       changed the most."""
+    lines = []
+    stepsA = {f[:-7] for f in os.listdir(runDirA) if f.endswith(".pstats")}
+    stepsB = {f[:-7] for f in os.listdir(runDirB) if f.endswith(".pstats")}
+    for step in sorted(stepsA | stepsB):
+        if step not in stepsA or step not in stepsB:
+            lines.append(f"== {step}: only profiled in {runDirA if step in stepsA else runDirB}")
+            continue
+        timesA = FunctionTimes(os.path.join(runDirA, step + ".pstats"))
+        timesB = FunctionTimes(os.path.join(runDirB, step + ".pstats"))
+        totalA = sum(t[1] for t in timesA.values())
+        totalB = sum(t[1] for t in timesB.values())
+        lines.append(f"== {step}: {totalA:.2f}s -> {totalB:.2f}s ({totalB - totalA:+.2f}s)")
+        changes = []
+        for func in set(timesA) | set(timesB):
+            callsA, _, cumA = timesA.get(func, (0, 0.0, 0.0))
+            callsB, _, cumB = timesB.get(func, (0, 0.0, 0.0))
+            changes.append((cumB - cumA, func, cumA, cumB, callsA, callsB))
+        changes.sort(key=lambda change: abs(change[0]), reverse=True)
+        for delta, func, cumA, cumB, callsA, callsB in changes[:topN]:
+            lines.append(f"  {delta:+9.2f}s  {cumA:9.2f}s -> {cumB:9.2f}s  calls {callsA} -> {callsB}  {func}")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    # Compare two profiled runs, e.g.
+    #   python stepProfiler.py profiles/<run id A> profiles/<run id B> [top n]
+    if len(sys.argv) < 3:
+        print("Usage: python stepProfiler.py <run dir A> <run dir B> [top n]")
+        sys.exit(1)
+    print(Diff(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 20))
@@ -1,5 +1,6 @@
 import subprocess
 import os
+import argparse
 import pyodbc
 import importlib.util
 
@@ -10,6 +11,29 @@ root_folder = ['C:/MyApps'] # Only change if you clone he repo to a different lo
 n = ['5'] # The number of routes to process, use 196 for all routes (for Dublin 6th April) 
 # but this could take several hrs to run. 
 env = ['test'] # 'test' or 'production' - Determines which SQL DB to interact with
+pool_size = 5 # Connections kept open per SQL engine & Mongo client, shared by all steps
+idle_timeout = 300 # Seconds a pooled connection may sit idle before it is closed
+direct_routes = False # Tabulate routes straight into the route tables in Step 3 & skip Step 4
+route_archive = 'jsonl' # Where Step 3 keeps raw routes in direct mode, 'jsonl', 'cosmos' or None
+max_workers = 3 # Independent steps run at the same time, up to this many at once
+metrics_to_sql = True # Also save the run's metrics to the pipeline_metrics table
+
+# Steps are skipped when their inputs are unchanged since their last run. Use
+# --from to rerun a step & everything downstream of it, --only to rerun just
+# the named steps or --force to rerun everything, e.g.
+#   python run_pipeline.py --from routes
+#   python run_pipeline.py --only elevations temperature
+# --profile writes CPU, stack & allocation profiles of each step that runs to
+# profiles/<run id>, steps then run one at a time so each profile only holds
+# its own step. Compare two profiled runs with
+#   python pypackages/stepProfiler.py profiles/<run id> profiles/<run id>
+parser = argparse.ArgumentParser(description = 'Run the data pipeline')
+parser.add_argument('--from', dest = 'start', help = 'rerun this step & every step downstream of it')
+parser.add_argument('--only', nargs = '+', help = 'rerun only these steps')
+parser.add_argument('--force', action = 'store_true', help = 'rerun every step')
+parser.add_argument('--profile', action = 'store_true', help = 'profile each step that runs')
+parser.add_argument('--resume', metavar = 'RUN_ID', help = 'continue an interrupted run, keeping the items it collected')
+args = parser.parse_args()
 
 # Define Local Rscript location
 # NOTE: Change to suit your local configuration 
@@ -30,6 +54,19 @@ spec.loader.exec_module(functs)
 # File path Open secret key file stored local
 access_keys = functs.load_keys(path + '/keys.json')
 
+# Create the metrics shared by every step, written to a JSONL file as the run
+# goes with a run id to tell runs apart
+metrics = functs.loadPackage('pipelineMetrics').GetMetrics(path + '/pipeline_metrics.jsonl', args.resume)
+print('Run id: {}'.format(metrics.runId))
+
+# Open the checkpoint journal, the routing & elevation steps journal each item
+# they collect under the run id, so a run restarted with --resume <run id>
+# skips the items already done & retries only the ones that failed
+journal = functs.loadPackage('checkpointJournal').GetJournal(path + '/checkpoint_journal.sqlite', metrics.runId)
+
+# Load the index manifest, the indexes to build after each step
+index_manifest = functs.loadIndexManifest(path + '/index_manifest.json')
+
 # Create a connection to the Azure SQL database
 # =============================================
 conn_names = functs.load_connection_names(path + '\connection_names.json')
@@ -38,9 +75,29 @@ database = conn_names.sql_database + env[0]
 username = conn_names.sql_user
 connection_string = 'DRIVER={ODBC Driver 13 for SQL Server};SERVER=' + server + ';DATABASE=' + database +';UID=' + username + ';PWD=' + access_keys.sqldb_pwd
     
-# Connect to the database    
+# Connect to the database, this connection is used to fingerprint tables. A
+# pyodbc connection cannot be shared between threads, so each step opens its
+# own as steps may run at the same time.
 conn = pyodbc.connect(connection_string, autocommit = True)
 
+# Create the shared pool of SQL engines & Mongo clients used by every step
+pool = functs.loadPackage('resourcePool').GetPool(pool_size, idle_timeout)
+
+# Create a function to wrap a step so it runs with its own connection
+def withConnection (step) :
+    def run() :
+        step_conn = pyodbc.connect(connection_string, autocommit = True)
+        try :
+            step(step_conn)
+        finally :
+            step_conn.close()
+    return(run)
+
+# Create a function to run an R script with the standard arguments
+def runRscript (script) :
+    cmd = [rscript_command, pipeline_dir + script] + root_folder + n + env # Args
+    subprocess.check_output(cmd, universal_newlines = True)
+
 try:
     os.chdir(pipeline_dir)    
 # Catch invalid path    
@@ -51,97 +108,188 @@ except OSError as e:
     print("Error:" + str(e))
 else :    
     
+    profiler = None
+    if args.profile :
+        profiler = functs.loadPackage('stepProfiler').StepProfiler(pipeline_dir + 'profiles', metrics.runId)
+    
+    # The fingerprints of the last successful run of each step are kept here
+    pipelineDag = functs.loadPackage('pipelineDag')
+    dag = pipelineDag.PipelineDag(
+        stateFile = pipeline_dir + 'pipeline_state.json',
+        tableHash = lambda table: functs.tableFingerprint(table, conn),
+        maxWorkers = 1 if args.profile else max_workers,
+        metrics = metrics,
+        profiler = profiler)
+    run_args = {'n': n[0], 'env': env[0]}
+    # Steps reading the Python config or the GTFS feed list them as inputs,
+    # & each step that builds indexes fingerprints its part of the manifest
+    config_file = 'pypackages/data/config.py'
+    gtfs_zip = 'gtfs.zip'
+    def indexValues (step, values = None) :
+        return(dict(values or {}, indexes = index_manifest.get(step, [])))
+    gtfs_tables = ['agency', 'calendar', 'calendar_dates', 'bus_routes', 'shapes', 'stop_times', 'stops', 'trips', 'depots']
+    
     # STEP 1 - INGEST RAW GTFS DATA & SAVE TO AZURE SQL DB
     # ====================================================
-    # Build & run subprocess command
     # WARNING --- Saving the data to the DB takes sevral hours.
-    print('Step 1: Downloading & saving raw GTFS data to SQL DB')
-    script ='ingestGtfs.R'
-    cmd = [rscript_command, pipeline_dir + script] + root_folder + n + env # Args
-    subprocess.check_output(cmd, universal_newlines = True)
+    def ingestGtfs (step_conn) :
+        print('Step 1: Downloading & saving raw GTFS data to SQL DB')
+        runRscript('ingestGtfs.R')
+        # Create some indexes to help speed up later wrangling read times
+        functs.applyIndexManifest(step = 'step1', manifest = index_manifest, connection = step_conn)
     
-    # Create some indexes to help speed up later wrangling read times
-    functs.createIndex(col = 'trip_id', table = 'trips', connection = conn, curs = conn.cursor())
-    functs.createIndex(col = 'route_id', table = 'trips', connection = conn,  curs = conn.cursor())
-    functs.createIndex(col = 'route_id', table = 'bus_routes', connection = conn,  curs = conn.cursor())
-    functs.createIndex(col = 'shape_id', table = 'shapes', connection = conn,  curs = conn.cursor())
-    functs.createIndex(col = 'trip_id', table = 'stop_times', connection = conn,  curs = conn.cursor())
-    functs.createIndex(col = 'stop_id', table = 'stops', connection = conn,  curs = conn.cursor())
+    dag.Add('gtfs', withConnection(ingestGtfs),
+            files = ['ingestGtfs.R', 'functions.R', 'depot_mapping.csv', gtfs_zip],
+            values = indexValues('step1', run_args),
+            outputTables = gtfs_tables,
+            outputFiles = [gtfs_zip])
         
-    
     # STEP 2 - CREATE BLOCKS, DEAD TRIP & DEAD LEG INFO
     # =================================================
-    # Build & run subprocess command
     # WARNING --- This processing script takes several hours to run (if n not specificed).
-    print('Step 2: Create blocks & identify dead trips & legs')
-    script ='createBlockInfo.R'
-    cmd = [rscript_command, pipeline_dir + script] + root_folder + n + env # Args
-    subprocess.check_output(cmd, universal_newlines = True)
-        
-    print('Creating indexes as part of Step 2...')
-    # Create some indexes to help speed up later wrangling read times    
-    functs.createIndex(col = 'route_id', table = 'stop_analysis', connection = conn,  curs = conn.cursor())
-    functs.createIndex(col = 'service_id', table = 'stop_analysis', connection = conn,  curs = conn.cursor())
-    functs.createIndex(col = 'quasi_block', table = 'stop_analysis', connection = conn,  curs = conn.cursor())
+    def createBlockInfo (step_conn) :
+        print('Step 2: Create blocks & identify dead trips & legs')
+        runRscript('createBlockInfo.R')
+        print('Creating indexes as part of Step 2...')
+        # Create some indexes to help speed up later wrangling read times    
+        functs.applyIndexManifest(step = 'step2', manifest = index_manifest, connection = step_conn)
+    
+    dag.Add('blocks', withConnection(createBlockInfo),
+            after = ['gtfs'],
+            tables = ['depots', 'stops', 'bus_routes', 'trips', 'stop_times'],
+            files = ['createBlockInfo.R', 'functions.R', gtfs_zip],
+            values = indexValues('step2', run_args),
+            outputTables = ['stop_analysis', 'blocks', 'dead_leg_summary'])
     
     # STEP 3 - GET RAW ROUTE INFO FOR DEAD LEGS & DEAD TRIPS
     # ======================================================
-    import ingestNonGtfsRoutes
-    print('Step 3: Ingest non-GTFS route data & save to Cosmos DB')
-    ingestNonGtfsRoutes.run_all_ingr(
-            keys = access_keys, 
-            conn_string = connection_string, 
-            connection = conn)
+    # In direct mode Step 3 also writes the route tables
+    route_tables = ['dead_trip_routes', 'dead_leg_routes']
+    def ingestRoutes (step_conn) :
+        import ingestNonGtfsRoutes
+        print('Step 3: Ingest non-GTFS route data & save to Cosmos DB')
+        ingestNonGtfsRoutes.run_all_ingr(
+                keys = access_keys, 
+                conn_string = connection_string, 
+                connection = step_conn,
+                direct = direct_routes,
+                archive = route_archive)
+        if direct_routes :
+            # Index the route tables before Step 5 reads them
+            functs.applyIndexManifest(step = 'step4', manifest = index_manifest, connection = step_conn)
+    
+    dag.Add('routes', withConnection(ingestRoutes),
+            after = ['blocks'],
+            tables = ['stop_analysis', 'dead_leg_summary', 'stops', 'depots'],
+            files = ['ingestNonGtfsRoutes.py', 'functions.py', config_file, 'pypackages/urlHandler.py',
+                     'pypackages/mongoWriter.py', 'pypackages/fetchEngine.py', 'pypackages/checkpointJournal.py'],
+            values = indexValues('step4' if direct_routes else None, {'direct': direct_routes, 'archive': route_archive}),
+            outputTables = route_tables if direct_routes else ['dead_trip_log', 'dead_leg_log'])
     
     # STEP 4 - EXTRACT RAW ROUTE DATA & TRANSFORM
     # ===========================================
-    import extractTransformLoadRoutes
-    print('Step 4: Extract & transfrom non-GTFS data, save to SQL DB')
-    extractTransformLoadRoutes.run_all_etlr(
-            keys = access_keys, 
-            conn_string = connection_string,
-            connection = conn)  
-    
-    print('Creating indexes as part of Step 4...')
-    # Create some indexes to help speed up later wrangling read times 
-    functs.createIndex(col = 'dead_trip_unique_id', table = 'dead_trip_shapes', connection = conn,  curs = conn.cursor())
-    functs.createIndex(col = 'dead_trip_unique_id', table = 'dead_leg_shapes', connection = conn,  curs = conn.cursor())
+    # In direct mode Step 3 has already written the route tables
+    routes_step = 'routes'
+    if not direct_routes :
+        def transformRoutes (step_conn) :
+            import extractTransformLoadRoutes
+            print('Step 4: Extract & transfrom non-GTFS data, save to SQL DB')
+            extractTransformLoadRoutes.run_all_etlr(
+                    keys = access_keys, 
+                    conn_string = connection_string,
+                    connection = step_conn)  
+            # Index the route tables before Step 5 reads them
+            functs.applyIndexManifest(step = 'step4', manifest = index_manifest, connection = step_conn)
+        
+        dag.Add('etlr', withConnection(transformRoutes),
+                after = ['routes'],
+                tables = ['dead_trip_log', 'dead_leg_log'],
+                files = ['extractTransformLoadRoutes.py', 'functions.py', 'pypackages/routeCodec.py', 'pypackages/bulkLoader.py'],
+                values = indexValues('step4'),
+                outputTables = route_tables)
+        routes_step = 'etlr'
+    
+    # Simplify the GTFS & dead route shapes for each map zoom level in the app
+    def buildLods (step_conn) :
+        import buildShapeLods
+        print('Step 4: Build level of detail shapes for the app')
+        buildShapeLods.run_all_lods(
+                conn_string = connection_string,
+                connection = step_conn)
+        print('Creating indexes as part of Step 4...')
+        # Indexes already built on the route tables are left as they are
+        functs.applyIndexManifest(step = 'step4', manifest = index_manifest, connection = step_conn)
+    
+    dag.Add('lods', withConnection(buildLods),
+            after = [routes_step],
+            tables = ['shapes'] + route_tables,
+            files = ['buildShapeLods.py', 'pypackages/shapeSimplifier.py', 'pypackages/routeCodec.py'],
+            values = indexValues('step4'),
+            outputTables = ['shape_lods'])
     
     # STEP 5 - CREATE NETWORK SUMMARY INFO
     # ====================================
-    # Build & run subprocess command
     # WARNING --- This processing script takes several hours to run (if n not specificed).
-    print('Step 5: Create network summary & save to SQL DB')
-    script ='createBlockSummary.R'
-    cmd = [rscript_command, pipeline_dir + script] + root_folder + n + env # Args
-    subprocess.check_output(cmd, universal_newlines = True)    
+    def createBlockSummary (step_conn) :
+        print('Step 5: Create network summary & save to SQL DB')
+        runRscript('createBlockSummary.R')
+        print('Creating indexes as part of Step 5...')
+        # Create some indexes to help speed up app read times
+        functs.applyIndexManifest(step = 'step5', manifest = index_manifest, connection = step_conn)
     
-    print('Creating indexes as part of Step 5...')
-    # Create some indexes to help speed up app read times
-    functs.createIndex(col = 'route_id', table = 'distances', connection = conn,  curs = conn.cursor())
-    functs.createIndex(col = 'service_id', table = 'distances', connection = conn,  curs = conn.cursor())
-    functs.createIndex(col = 'quasi_block', table = 'distances', connection = conn,  curs = conn.cursor())
-    functs.createIndex(col = 'stop', table = 'distances', connection = conn,  curs = conn.cursor())    
+    dag.Add('summary', withConnection(createBlockSummary),
+            after = [routes_step],
+            tables = ['blocks', 'stop_analysis', 'dead_leg_summary', 'depots', 'stops', 'trips', 'stop_times'] + route_tables,
+            files = ['createBlockSummary.R', 'functions.R'],
+            values = indexValues('step5', run_args),
+            outputTables = ['distances', 'block_summary'])
 
     # STEP 6 - COLLECT ELEVATION DATA
     # ====================================
     # Collect all elevations for each coordinate in the stops schema
     # Upload collected elevations to the stopEelevations schema
-    import CollectStopElevations
-    print('Step 6: Gather elevations as part of Step 6...')
-    CollectStopElevations.collectStopElevations()
-    functs.createIndex(col = 'latitude', table = 'stopElevations', connection = conn,  curs = conn.cursor())    
-    functs.createIndex(col = 'longitude', table = 'stopElevations', connection = conn,  curs = conn.cursor())    
+    # Only needs the GTFS stops, so runs alongside Steps 2 to 5
+    def collectElevations (step_conn) :
+        import CollectStopElevations
+        print('Step 6: Gather elevations as part of Step 6...')
+        CollectStopElevations.collectStopElevations()
+        functs.applyIndexManifest(step = 'step6', manifest = index_manifest, connection = step_conn)
+    
+    dag.Add('elevations', withConnection(collectElevations),
+            after = ['gtfs'],
+            tables = ['stops', 'depots'],
+            files = ['CollectStopElevations.py', config_file, 'pypackages/elevationProvider.py',
+                     'pypackages/elevationCache.py', 'pypackages/fetchEngine.py', 'pypackages/checkpointJournal.py'],
+            values = indexValues('step6'),
+            outputTables = ['stopElevations'])
     
     # STEP 7 - CREATE TEMPERATURE STATS
     # =================================
-    # Build & run subprocess command    
-    print('Step 7: Create temperature stats & save to SQL DB')
-    script ='temperatureStats.R'
-    cmd = [rscript_command, pipeline_dir + script] + root_folder + n + env # Args
-    subprocess.check_output(cmd, universal_newlines = True)
+    # Only needs the weather data file, so runs alongside every other step
+    def temperatureStats (step_conn) :
+        print('Step 7: Create temperature stats & save to SQL DB')
+        runRscript('temperatureStats.R')
+    
+    dag.Add('temperature', withConnection(temperatureStats),
+            files = ['temperatureStats.R', 'functions.R', 'hly532.csv'],
+            values = run_args,
+            outputTables = ['temperature_stats'])
+    
+    outcomes = dag.Run(start = args.start, only = args.only, force = args.force)
+    print('Pipeline steps: {}'.format(outcomes))
     
 finally :
+    # Record the run totals of every timer & counter
+    metrics.Flush()
+    if metrics_to_sql :
+        try :
+            metrics.SaveToSQL(pool.SQLEngine(connection_string))
+        except Exception as e :
+            print('Metrics not saved to SQL: ' + str(e))
+    journal.Close()
+    # Report how often pooled connections were reused & close them
+    print('Connection pool: {}'.format(pool.Counters()))
+    pool.CloseAll()
     # return to root directory
     os.chdir(root_folder[0] + '\dapTbElectricDublinBus')
 
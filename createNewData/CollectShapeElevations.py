@@ -1,6 +1,5 @@
-from sys import getsizeof as dictsize
-import time
 import urllib
+import numpy as np
 import pandas as pd
 import urllib.request
 
@@ -8,90 +7,91 @@ try:
     import createNewData.data.config as in_config
     from createNewData.pypackages.Azure import Azure
     from createNewData.pypackages.urlHandler import UrlHandler
+    from _pipeline.pypackages.elevationProvider import GetProvider
+    from _pipeline.pypackages.shapeSimplifier import ShapeSimplifier
     AzurePackage = Azure(in_config)
     Url = UrlHandler(in_config)
-    
-    
+
+
 except ImportError as e:
     print(in_config.FailedImport)
     print(e)
 
-def collectStopElevations():
-    listOfBatches = []
-    batches = {"locations" : []}
+def interpolateShapeElevations(shapes, shapesRequest, simplifier):
+    """Join every simplified shape point to the elevations looked up for the
+       kept coordinates and fill in the dropped points by interpolating along
+       the distance of each shape."""
+    dfJoined = shapes.merge(shapesRequest, on=["shape_pt_lat", "shape_pt_lon"], how="left")
+    # Only kept points are measured, a dropped point sharing a kept point's
+    # coordinates must still be interpolated so the shape stays consistent
+    dfJoined["elevation"] = dfJoined["elevation"].where(dfJoined["keep"])
+    dfJoined["elevation"] = simplifier("Interpolate", dfJoined, "elevation")
+    return dfJoined[in_config.longLatCol + ["shape_pt_sequence", "distance_m", "keep", "elevation"]]
+
+def collectShapeElevations():
+    #===========================================================================
+    # 1. Simplify Shapes
+    #===========================================================================
+    # A. Collect the id, sequence & coordinates of every shape point from the
+    #    'shapes' schema, the other columns are never read.
+    # B. Thin points closer than shapeSpacing metres and run Douglas-Peucker
+    #    at shapeTolerance metres per shape_id, keeping every point flagged.
+    # C. Request elevations only for the distinct coordinates of kept points.
+    #-----------------------------------------------------
+    # Attributes
+    #-----------------------------------------------------
+    # Azure class imported with call functionality (in)
+    # Config File (in)
+    # shapes (out)
+    # shapesRequest (out)
+
+    simplifier = ShapeSimplifier(in_config.shapeTolerance, in_config.shapeSpacing)
+    shapes = pd.DataFrame(columns=in_config.longLatCol + ["shape_pt_sequence", "distance_m", "keep"])
+    shapesRequest = pd.DataFrame(columns=["shape_pt_lat", "shape_pt_lon"])
     try:
-        rawShapedf = AzurePackage("SelectAllData", "stops")
-        shapesDF = rawShapedf[["stop_id", "stop_lat","stop_lon"]]
-        shapesRequest = shapesDF.drop_duplicates(subset=None, 
-                                                keep='first', 
-                                                inplace=False)
-        shapesCoordinates = Url("generateLocationRequest", shapesRequest)
-        for key, value in shapesCoordinates.items():
-            if key == "locations":
-                locations = value
-        while len(locations) != 0:
-            for each in locations:
-                if dictsize(batches["locations"]) +\
-                                    dictsize(each) +\
-                                    dictsize(batches) < 9700:
-                    location = locations.pop(0)
-                    batches["locations"].append(location)
-                else:
-                    location = locations.pop(0)
-                    batches["locations"].append(location)
-                    listOfBatches.append(batches)
-                    batches = {"locations" : []}
-            for each in listOfBatches:
-                if dictsize(each) > 10000:
-                    raise Exception(in_config.RequestToBig)
-                else:
-                    pass
-        else:
-            print("All values added to the list of requests.")
+        shapesDF = AzurePackage("SelectData", "shapes", in_config.longLatCol + ["shape_pt_sequence"])
+        shapes = simplifier("Simplify", shapesDF)
+        print(f"Shapes simplified: {simplifier('Stats')}")
+        shapesRequest = shapes.loc[shapes["keep"], ["shape_pt_lat", "shape_pt_lon"]]\
+                              .drop_duplicates().reset_index(drop=True)
     except pd.io.sql.DatabaseError as e:
         print(in_config.NoSQLShema)
 
     except urllib.request.HTTPError as e:
         if e.code == "403":
             print(in_config.SQLConnectionFail)
-        
+
     except Exception as e:
         print(in_config.UNKMGO)
         print(e)
 
-    listOfObjects = []
-    listOfElevations = []
-    ListOfDicts = []
-
-    print(f"There are {len(listOfBatches)} batches to collect.")
+    #===========================================================================
+    # 2. Collect Elevations
+    #===========================================================================
+    # A. Look up the elevation of each kept coordinate with the provider set in
+    #    the config file.
+    # B. Interpolate the elevation of every dropped point from the kept
+    #    points either side of it by distance along the shape.
+    # C. Upload every shape point with its elevation, the keep column marks
+    #    the points whose elevation was looked up.
+    #-----------------------------------------------------
+    # Attributes
+    #-----------------------------------------------------
+    # shapes (in)
+    # shapesRequest (in)
+    print(f"There are {len(shapesRequest)} elevations to collect.")
 
-    Iteration = 0
     try:
-        for each in listOfBatches:
-                attempts = 0
-                while attempts < 5:
-                    try:
-                        ListOfDicts.append(Url("mineElevationData",each))
-                        break
-                    except urllib.error.HTTPError:
-                        attempts = attempts+1
-                Iteration = Iteration + 1
-                print(f"Elevation {Iteration} Collected")
-                time.sleep(2)
-        for each in ListOfDicts:
-            for key, value in each.items():
-                if type(value) is list:
-                    listOfObjects.append(value)
-
-        for each in listOfObjects:
-            for elevation in each:
-                listOfElevations.append(elevation)
-                Iteration = Iteration +1
-        df = pd.DataFrame(listOfElevations)
-        dfTrimmed = df.drop_duplicates()
+        provider = GetProvider(in_config, Url)
+        elevations = provider("Lookup", shapesRequest["shape_pt_lat"], shapesRequest["shape_pt_lon"])
+        if np.isnan(elevations).any():
+            raise Exception("Failed to collect all elevations, please try again.")
+        print(f"{len(elevations)} Elevations Collected")
+        shapesRequest = shapesRequest.assign(elevation=elevations)
+        dfTrimmed = interpolateShapeElevations(shapes, shapesRequest, simplifier)
         try:
             sumElevation = dfTrimmed["elevation"].sum()
-        except: 
+        except:
             raise Exception("Failed to collect all elevations, please try again.")
     except KeyError as e:
         print(f"Column {e} cannot be found in the dataframe.")
@@ -102,10 +102,10 @@ def collectStopElevations():
         print(type(e))
         print(e)
     try:
-        print("Uploading to SQL.")
+        print(f"Uploading {len(dfTrimmed)} shape points, {int(dfTrimmed['keep'].sum())} with collected elevations, to SQL.")
         SqlDataCursor = AzurePackage("UploadToSQL",
                                     dfTrimmed,
-                                    "stopElevations",
+                                    "shapeElevations",
                                     in_config.teamConnQuote)
         print("Upload Complete.")
     except pd.io.sql.DatabaseError as e:
@@ -115,4 +115,4 @@ def collectStopElevations():
         print(e)
 
 if __name__ == '__main__':
-    collectStopElevations()
\ No newline at end of file
+    collectShapeElevations()
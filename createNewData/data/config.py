@@ -79,6 +79,8 @@ SQLStr = """SELECT {0}
 
 SQLSelect = SQLStr = """SELECT * FROM {0}"""
 
+SQLSelectColumns = """SELECT {0}{1} FROM {2}"""
+
 SQLElevation = """SELECT
                     [dbo].[shapes].shape_id,[dbo].[shapes].shape_pt_lat,[dbo].[shapes].shape_pt_lon,[dbo].[shapes].shape_pt_sequence,
                     [dbo].[elevations].elevation
@@ -116,6 +118,26 @@ SQLConnectionFail = "Failed to connect to SQL database, please ensure that conne
 #---------------------------------------
 
 
+# Largest request body the Open-Elevation API accepts, in bytes
+elevRequestLimit = 10000
+
+# Concurrent elevation requests, at most elevWorkers in flight and
+# elevRatePerSecond started per second, each retried elevRetries times
+elevWorkers = 4
+elevRatePerSecond = 2
+elevRetries = 5
+
+# Elevation source, "open-elevation" for the API or "dem" for the
+# SRTM .hgt or GeoTIFF tiles in demTileDir
+elevationProvider = "open-elevation"
+demTileDir = os.environ.get("DEMTILEDIR", "dem_tiles")
+
+# Shape simplification before elevation requests, points closer than
+# shapeSpacing metres are thinned and the rest are kept to within
+# shapeTolerance metres of the full path
+shapeTolerance = 5.0
+shapeSpacing = 10.0
+
 elevHeaders = {'Accept':'application/json',
                'Content-Type':'application/json'
                }
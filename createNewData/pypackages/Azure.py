@@ -28,6 +28,8 @@ class Azure():
             return self.dropMongoColl(args[1])
         elif args[0] == "SelectAllData":
             return self.SelectAllData(args[1])
+        elif args[0] == "SelectData":
+            return self.SelectData(*args[1:])
         else:
             return "Object does not exist."
 
@@ -126,6 +128,24 @@ class Azure():
         conn.close()
         return df
     
+    def SelectData(self, tablename, columns=None, where=None, params=None, distinct=False):
+        """Return data from a database schema, with the column
+           selection, filtering and de-duplication done by the database.
+           Requires: table name. Optional: list of columns, WHERE
+           clause with ? placeholders and its params, DISTINCT."""
+        if columns:
+            columnString = ", ".join("[{}]".format(c) for c in columns)
+        else:
+            columnString = "*"
+        SQLString = self.in_config.SQLSelectColumns.format(
+            "DISTINCT " if distinct else "", columnString, tablename)
+        if where:
+            SQLString = SQLString + " WHERE " + where
+        conn = self.AzureDBConn(self.in_config.teamConnQuote)
+        df = pd.read_sql(SQLString, conn, params=list(params) if params is not None else None)
+        conn.close()
+        return df
+    
     def SelectLongLat(self, columns, tablename, columnName, shape):
         """Collect all the data in a table that 
            contains the shape name in 
@@ -1,6 +1,9 @@
 import urllib
 import urllib.request
 import json
+import time
+import numpy as np
+import pandas as pd
 from math import sqrt
 from geopy.distance import great_circle
 from geopy.distance import geodesic
@@ -20,6 +23,14 @@ class UrlHandler():
             return self.callURL(args[1], args[2], args[3])
         elif args[0] == "generateLocationRequest":
             return self.generateLocationRequest(args[1])
+        elif args[0] == "generateLocationBatches":
+            return self.generateLocationBatches(args[1], args[2])
+        elif args[0] == "encodeLocations":
+            return self.encodeLocations(args[1])
+        elif args[0] == "packLocationBatches":
+            return self.packLocationBatches(args[1], args[2])
+        elif args[0] == "benchmarkLocationRequest":
+            return self.benchmarkLocationRequest(args[1])
         elif args[0] == "EuclideanDist":
             return self.EuclideanDist(args[1], args[2], 
                                       args[3],args[4], 
@@ -35,7 +46,69 @@ class UrlHandler():
         response = urllib.request.urlopen(req, timeout=500000)
         return response
         
-    def generateLocationRequest(self, shapeData):
+    def locationColumns(self, shapeData, latColumn=None, lonColumn=None):
+        """Return the latitude and longitude columns of a dataframe as
+           lists, found by name if not given, e.g. stop_lat/stop_lon or
+           shape_pt_lat/shape_pt_lon."""
+        if latColumn is None:
+            latColumn = [c for c in shapeData.columns if c.endswith("lat") or c == "latitude"][0]
+        if lonColumn is None:
+            lonColumn = [c for c in shapeData.columns if c.endswith("lon") or c == "longitude"][0]
+        return shapeData[latColumn].tolist(), shapeData[lonColumn].tolist()
+
+    def generateLocationRequest(self, shapeData, latColumn=None, lonColumn=None):
+        latitudes, longitudes = self.locationColumns(shapeData, latColumn, lonColumn)
+        locationDict = {"locations": [{"latitude": lat, "longitude": lon}
+                                      for lat, lon in zip(latitudes, longitudes)]}
+        return locationDict
+
+    def encodeLocations(self, shapeData, latColumn=None, lonColumn=None):
+        """Serialize each location to the same Json text that
+           json.dumps gives for it in a request."""
+        latitudes, longitudes = self.locationColumns(shapeData, latColumn, lonColumn)
+        return [f'{{"latitude": {lat!r}, "longitude": {lon!r}}}'
+                for lat, lon in zip(latitudes, longitudes)]
+
+    def generateLocationBatches(self, shapeData, batchSize, latColumn=None, lonColumn=None):
+        """Yield request bodies of at most batchSize locations as
+           pre-serialized Json bytes, ready for mineElevationData."""
+        encoded = self.encodeLocations(shapeData, latColumn, lonColumn)
+        for start in range(0, len(encoded), batchSize):
+            body = '{"locations": [' + ", ".join(encoded[start:start + batchSize]) + ']}'
+            yield body.encode("utf8")
+
+    def packLocationBatches(self, encoded, limit):
+        """Pack serialized locations into as few request bodies as
+           possible, each no more than limit bytes once encoded, in a
+           single pass. Returns the bodies and the batch count and
+           average fill ratio."""
+        prefix = '{"locations": ['
+        suffix = ']}'
+        separator = ', '
+        emptySize = len(prefix) + len(suffix)
+        batches = []
+        current = []
+        currentSize = emptySize
+        for location in encoded:
+            size = len(location.encode("utf8"))
+            if emptySize + size > limit:
+                raise Exception(self.in_config.RequestToBig)
+            extra = size + (len(separator) if current else 0)
+            if currentSize + extra > limit:
+                batches.append((prefix + separator.join(current) + suffix).encode("utf8"))
+                current = []
+                currentSize = emptySize
+                extra = size
+            current.append(location)
+            currentSize += extra
+        if current:
+            batches.append((prefix + separator.join(current) + suffix).encode("utf8"))
+        fillRatio = sum(len(b) for b in batches) / (len(batches) * limit) if batches else 0
+        return batches, {"batches": len(batches), "fillRatio": fillRatio}
+
+    def generateLocationRequestIterrows(self, shapeData):
+        """Previous row by row implementation of generateLocationRequest,
+           kept for benchmarking."""
         listofLocations = []
         locationDict = {}
         for index,row in shapeData.iterrows():
@@ -46,9 +119,36 @@ class UrlHandler():
         locationDict["locations"] = listofLocations
         return locationDict
 
+    def benchmarkLocationRequest(self, nRows=100000):
+        """Time the row by row and vectorized request builders on
+           random stop data and check that they agree."""
+        shapeData = pd.DataFrame({"stop_id": np.arange(nRows).astype(str),
+                                  "stop_lat": np.random.uniform(53.2, 53.5, nRows),
+                                  "stop_lon": np.random.uniform(-6.4, -6.1, nRows)})
+        start = time.time()
+        oldRequest = self.generateLocationRequestIterrows(shapeData)
+        oldSeconds = time.time() - start
+        start = time.time()
+        newRequest = self.generateLocationRequest(shapeData)
+        newSeconds = time.time() - start
+        start = time.time()
+        batches = list(self.generateLocationBatches(shapeData, 1000))
+        batchSeconds = time.time() - start
+        if json.dumps(oldRequest) != json.dumps(newRequest):
+            raise Exception("Vectorized location request does not match.")
+        if [json.loads(b) for b in batches] != [{"locations": newRequest["locations"][i:i + 1000]}
+                                                for i in range(0, nRows, 1000)]:
+            raise Exception("Serialized location batches do not match.")
+        print(f"iterrows: {oldSeconds:.3f}s, vectorized: {newSeconds:.3f}s, "
+              f"serialized batches: {batchSeconds:.3f}s for {nRows} rows")
+        return {"iterrows": oldSeconds, "vectorized": newSeconds, "batches": batchSeconds}
+
     def mineElevationData(self, shapeData):
         # data = self.generateLocationRequest(shapeData)
-        body = str.encode(json.dumps(shapeData))
+        if isinstance(shapeData, bytes):
+            body = shapeData
+        else:
+            body = str.encode(json.dumps(shapeData))
         response = self.callURL(in_config.url, body, in_config.elevHeaders)
         jsonReadyData = response.read().decode('utf8').replace("'", '"')
         elevationData = json.loads(jsonReadyData)
@@ -58,8 +158,9 @@ class UrlHandler():
         alt_1 = alt1
         alt_2 = alt2
         dalt = alt_1-alt_2
-        p1 = (lon1, lat1)
-        p2 = (lon2, lat2)
+        # geopy expects (latitude, longitude)
+        p1 = (lat1, lon1)
+        p2 = (lat2, lon2)
         calt = geodesic(p1, p2).meters
         trueDistance = sqrt(calt**2 + dalt**2)
         return trueDistance
\ No newline at end of file